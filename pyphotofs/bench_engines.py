@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# Requires Python 3, pyfuse3 and trio
+"""
+Compares the threaded and trio mount engines by driving their operation
+objects directly (no kernel mount needed).  Each simulated client looks up
+a random image, opens it, reads it in chunks and releases it.
+
+    bench_engines.py iphotolibrary [concurrency] [requests]
+"""
+from __future__ import print_function
+
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import trio
+
+from iphoto import iPhotoLibrary, human_size
+from iphotofuse_async import iPhoto_Async_FS, _ContextFreeFS
+
+__author__ = "Robert Harder"
+__email__ = "rob@iharder.net"
+__copyright__ = "This code is released into the Public Domain"
+__version__ = "0.1"
+__status__ = "Development"
+
+CHUNK = 128 * 1024
+
+
+def image_paths(library):
+    paths = []
+    for c_type in ('Albums', 'Rolls'):
+        for coll in library.collections(c_type):
+            for img in coll.images:
+                if img is not None:
+                    paths.append('/{}/{}/{}'.format(c_type, coll.name, img.filename))
+    return paths
+
+
+def bench_threads(library, paths, concurrency):
+    fs = _ContextFreeFS(library)
+
+    def client(path):
+        size = fs.getattr(path)['st_size']
+        fh = fs.open(path)
+        try:
+            offset = 0
+            while offset < size:
+                offset += len(fs.read(path, CHUNK, offset, fh))
+        finally:
+            fs.release(path, fh)
+        return size
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return sum(pool.map(client, paths))
+
+
+def bench_trio(library, paths, concurrency):
+    fs = iPhoto_Async_FS(library, max_threads=concurrency)
+    total = [0]
+
+    async def lookup(path):
+        inode = 1  # pyfuse3.ROOT_INODE
+        entry = None
+        for name in path.strip('/').split('/'):
+            entry = await fs.lookup(inode, name.encode('utf-8'))
+            inode = entry.st_ino
+        return entry
+
+    async def client(path, limiter):
+        async with limiter:
+            entry = await lookup(path)
+            info = await fs.open(entry.st_ino, 0)
+            try:
+                offset = 0
+                while offset < entry.st_size:
+                    offset += len(await fs.read(info.fh, offset, CHUNK))
+            finally:
+                await fs.release(info.fh)
+            total[0] += entry.st_size
+
+    async def run():
+        limiter = trio.CapacityLimiter(concurrency)
+        async with trio.open_nursery() as nursery:
+            for path in paths:
+                nursery.start_soon(client, path, limiter)
+
+    trio.run(run)
+    return total[0]
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        exit(1)
+    library = iPhotoLibrary(sys.argv[1])
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    num_requests = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+
+    all_paths = image_paths(library)
+    paths = [random.choice(all_paths) for _ in range(num_requests)]
+
+    for name, bench in (('threads', bench_threads), ('trio', bench_trio)):
+        start = time.time()
+        nbytes = bench(library, paths, concurrency)
+        elapsed = time.time() - start
+        print("{:8s} {:6d} requests in {:.2f}s: {:.0f} req/s, {}/s".format(
+            name, num_requests, elapsed, num_requests / elapsed, human_size(nbytes / elapsed)))
+
+
+if __name__ == '__main__':
+    main()
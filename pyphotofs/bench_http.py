@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# Should work with Python 2 or 3
+"""
+Measures how fast the HTTP server answers concurrent byte-range requests.
+A local server is started on a free port and each simulated client keeps
+one connection alive while it asks for random ranges of random images,
+checking every response against the file on disk.
+
+    bench_http.py iphotolibrary [concurrency] [requests] [range_bytes]
+"""
+from __future__ import print_function
+
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+
+from iphotohttp import *
+
+try:
+    from http.client import HTTPConnection
+    from urllib.parse import quote
+except ImportError:  # Python 2
+    from httplib import HTTPConnection
+    from urllib import quote
+
+__author__ = "Robert Harder"
+__email__ = "rob@iharder.net"
+__copyright__ = "This code is released into the Public Domain"
+__version__ = "0.1"
+__status__ = "Development"
+
+
+def image_urls(library):
+    """
+    Returns (url path, file path, size) for every image in every album and roll.
+    """
+    urls = []
+    for c_type in ('Albums', 'Rolls'):
+        for coll in library.collections(c_type):
+            for img in coll.images:
+                if img is not None and os.path.exists(img.abspath):
+                    urls.append((quote('/{}/{}/{}'.format(c_type, coll.name, img.filename)),
+                                 img.abspath, os.path.getsize(img.abspath)))
+    return urls
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def bench(server, urls, concurrency, num_requests, range_bytes):
+    """
+    :return: latencies in seconds, bytes received, and the number of wrong responses
+    :rtype: ([float], int, int)
+    """
+    host, port = server.server_address[:2]
+    per_client = [num_requests // concurrency + (1 if i < num_requests % concurrency else 0)
+                  for i in range(concurrency)]
+
+    def client(count):
+        conn = HTTPConnection(host, port)
+        latencies, nbytes, errors = [], 0, 0
+        try:
+            for _ in range(count):
+                url, path, size = random.choice(urls)
+                start = random.randint(0, max(0, size - 1))
+                end = min(size, start + range_bytes) - 1
+                began = time.time()
+                conn.request('GET', url, headers={'Range': 'bytes={}-{}'.format(start, end)})
+                response = conn.getresponse()
+                body = response.read()
+                latencies.append(time.time() - began)
+                nbytes += len(body)
+                with open(path, 'rb') as fp:
+                    fp.seek(start)
+                    if response.status != 206 or body != fp.read(end - start + 1):
+                        errors += 1
+        finally:
+            conn.close()
+        return latencies, nbytes, errors
+
+    latencies, nbytes, errors = [], 0, 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for l, n, e in pool.map(client, per_client):
+            latencies.extend(l)
+            nbytes += n
+            errors += e
+    return latencies, nbytes, errors
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        exit(1)
+    library = iPhotoLibrary(sys.argv[1])
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    num_requests = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+    range_bytes = int(sys.argv[4]) if len(sys.argv) > 4 else 256 * 1024
+
+    urls = image_urls(library.generation)
+    if not urls:
+        print("No images to request in", str(library))
+        exit(1)
+    server = iPhotoHTTPServer(library, ('127.0.0.1', 0))
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        start = time.time()
+        latencies, nbytes, errors = bench(server, urls, concurrency, num_requests, range_bytes)
+        elapsed = time.time() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    latencies.sort()
+    print("{} clients, {} range requests of up to {} in {:.2f}s: {:.0f} req/s, {}/s".format(
+        concurrency, len(latencies), human_size(range_bytes), elapsed, len(latencies) / elapsed,
+        human_size(max(nbytes / elapsed, 1))))
+    print("latency p50={:.2f}ms p90={:.2f}ms p99={:.2f}ms max={:.2f}ms".format(
+        *[1000 * percentile(latencies, f) for f in (0.5, 0.9, 0.99, 1.0)]))
+    if errors:
+        print(errors, "responses did not match the files on disk")
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# Should work with Python 2 or 3 on systems with UNIX sockets
+"""
+Looks inside a running mount without remounting it.
+
+A mount started with the control option listens on a UNIX socket.  Each
+connection sends one command line and gets back a plain-text answer:
+
+    status                      loading state and cache sizes
+    profile start [interval_ms] start sampling every thread's stack
+    profile show [n]            the n hottest functions so far
+    profile stop [n]            stop sampling, and show the hottest functions
+    trace start FILE            record every operation to FILE (see optrace.py)
+    trace stop                  stop recording
+
+The profiler samples rather than instruments: a background thread looks at
+what every thread is running every few milliseconds.  cProfile would only
+see the thread that switched it on, while FUSE requests arrive on many.
+
+    control.py socket command [arguments]
+"""
+from __future__ import print_function
+
+import os
+import socket
+import sys
+import time
+from collections import Counter
+from threading import Event, Lock, Thread
+
+__author__ = "Robert Harder"
+__email__ = "rob@iharder.net"
+__copyright__ = "This code is released into the Public Domain"
+__version__ = "0.1"
+__status__ = "Development"
+
+CONTROL_SOCKET_NAME = 'control.sock'
+
+
+class SamplingProfiler(object):
+    """
+    Counts which functions every other thread is running, sampled at a fixed interval.
+    """
+
+    def __init__(self, interval=0.005, ignore=()):
+        """
+        :param float interval: seconds between samples
+        :param ignore: idents of threads not worth sampling
+        """
+        self.interval = interval
+        self._ignore = set(ignore)
+        self.samples = 0
+        self._own = Counter()  # (file, line, function) -> samples with it at the top of a stack
+        self._total = Counter()  # ... -> samples with it anywhere on a stack
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+        self.started = None
+
+    def start(self):
+        self.started = time.time()
+        self._thread = Thread(target=self._run, name='iphotofs-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        self._ignore.add(self._thread.ident)
+        while not self._stopped.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, frame in frames.items():
+                    if ident in self._ignore:
+                        continue
+                    self._own[self._key(frame)] += 1
+                    seen = set()
+                    while frame is not None:
+                        key = self._key(frame)
+                        if key not in seen:
+                            seen.add(key)
+                            self._total[key] += 1
+                        frame = frame.f_back
+                self.samples += 1
+
+    @staticmethod
+    def _key(frame):
+        code = frame.f_code
+        return code.co_filename, code.co_firstlineno, code.co_name
+
+    def report(self, limit=25):
+        """
+        Describes the functions seen most often at the top of a stack.
+        :param int limit: how many functions to list
+        :rtype: str
+        """
+        with self._lock:
+            own = self._own.most_common(limit)
+            total = dict(self._total)
+            samples = self.samples
+        lines = ["{} samples over {:.1f}s".format(samples, time.time() - (self.started or time.time())),
+                 "{:>7s} {:>7s}  {}".format('own', 'total', 'function')]
+        for (filename, line, name), count in own:
+            lines.append("{:>7d} {:>7d}  {} ({}:{})".format(
+                count, total.get((filename, line, name), 0), name, os.path.basename(filename), line))
+        return '\n'.join(lines) + '\n'
+
+
+class ControlServer(object):
+    """
+    Answers commands about an iPhoto_FUSE_FS on a UNIX socket.
+    """
+
+    def __init__(self, fs, path):
+        """
+        :param iphotofuse.iPhoto_FUSE_FS fs: the filesystem to control
+        :param str path: where to create the socket
+        """
+        self._fs = fs
+        self.path = path
+        self._profiler = None
+        self._sock = None
+        self._thread = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)  # Left over from a mount that didn't shut down cleanly
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self._sock.listen(4)
+        self._thread = Thread(target=self._serve, name='iphotofs-control')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        if self._profiler is not None:
+            self._profiler.stop()
+        if self._fs.trace is not None:
+            self._fs.trace.close()
+            self._fs.trace = None
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except (OSError, AttributeError):
+                return  # Socket closed by stop()
+            try:
+                request = b''
+                while not request.endswith(b'\n'):
+                    chunk = conn.recv(4096)
+                    if not chunk:
+                        break
+                    request += chunk
+                try:
+                    answer = self.handle(request.decode('utf-8').split())
+                except Exception as e:
+                    answer = "error: {}\n".format(e)
+                conn.sendall(answer.encode('utf-8'))
+            finally:
+                conn.close()
+
+    def handle(self, words):
+        """
+        Carries out one command.
+        :param [str] words: the command and its arguments
+        :return: the answer
+        :rtype: str
+        """
+        command = ' '.join(words[:2])
+        args = words[2:]
+        if words[:1] == ['status']:
+            status = self._fs.library.load_status()
+            lines = ['{}: {}'.format(k, v) for k, v in status.items()]
+            lines += ['cache {}: {}'.format(k, v) for k, v in self._fs.cache_sizes().items()]
+            lines.append('profiling: {}'.format('yes' if self._profiler is not None else 'no'))
+            lines.append('tracing: {}'.format(self._fs.trace.path if self._fs.trace is not None else 'no'))
+            return '\n'.join(lines) + '\n'
+
+        elif command == 'profile start':
+            if self._profiler is not None:
+                return "already profiling\n"
+            self._profiler = SamplingProfiler(float(args[0]) / 1000 if args else 0.005,
+                                              ignore=[self._thread.ident])
+            self._profiler.start()
+            return "profiling\n"
+        elif command in ('profile show', 'profile stop'):
+            profiler = self._profiler
+            if profiler is None:
+                return "not profiling\n"
+            if command == 'profile stop':
+                profiler.stop()
+                self._profiler = None
+            return profiler.report(int(args[0]) if args else 25)
+
+        elif command == 'trace start':
+            from optrace import TraceRecorder
+            if not args:
+                return "usage: trace start FILE\n"
+            if self._fs.trace is not None:
+                return "already tracing to {}\n".format(self._fs.trace.path)
+            self._fs.trace = TraceRecorder(os.path.abspath(args[0]))
+            return "tracing to {}\n".format(self._fs.trace.path)
+        elif command == 'trace stop':
+            trace = self._fs.trace
+            if trace is None:
+                return "not tracing\n"
+            self._fs.trace = None  # Set aside first so no operation records to a closed file
+            trace.close()
+            return "{}\n".format(trace)
+
+        return "unknown command; try status, profile start|show|stop, trace start FILE|stop\n"
+
+
+def send_command(path, words, timeout=60):
+    """
+    Sends one command to a running mount's control socket.
+    :param str path: the socket
+    :param [str] words: the command and its arguments
+    :return: the answer
+    :rtype: str
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall((' '.join(words) + '\n').encode('utf-8'))
+        answer = b''
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            answer += chunk
+    finally:
+        sock.close()
+    return answer.decode('utf-8')
+
+
+def main():
+    if len(sys.argv) < 3:
+        print(__doc__)
+        exit(1)
+    sys.stdout.write(send_command(sys.argv[1], sys.argv[2:]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# Python 3, or Python 2 with the futures backport
+"""
+Finds byte-identical masters in an iPhoto library.
+
+Every master is hashed by a pool of threads, one per CPU (hashlib and file
+reads release the GIL, and a mount can't safely fork worker processes from
+its many threads), and the digests are saved in the library's cache_dir
+keyed by each file's size and modification time.  Running it again only
+hashes files that are new or have changed.
+"""
+from __future__ import print_function
+
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from iphoto import *
+
+__author__ = "Robert Harder"
+__email__ = "rob@iharder.net"
+__copyright__ = "This code is released into the Public Domain"
+__version__ = "0.1"
+__status__ = "Development"
+
+_HASH_CHUNK = 1024 * 1024
+
+
+def hash_file(path):
+    """
+    Returns the SHA-256 hex digest of a file, or None if it can't be read.
+    :param str path: the file
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(_HASH_CHUNK), b''):
+                digest.update(chunk)
+    except (IOError, OSError):
+        return None
+    return digest.hexdigest()
+
+
+class ContentIndex(object):
+    """
+    Content digests of a library's masters, persisted between runs.
+    Safe to use from many threads at once.
+    """
+
+    _CACHE_FILE = 'hashes.json'
+
+    def __init__(self, library, workers=None, verbose=False):
+        """
+        :param iphoto.iPhotoLibrary library: the library
+        :param int workers: number of hashing threads (defaults to the number of CPUs)
+        """
+        self._library = library
+        self._workers = workers or multiprocessing.cpu_count()
+        self.verbose = verbose
+        self._cache_path = os.path.join(library.cache_dir, self._CACHE_FILE)
+        self._lock = Lock()
+        try:
+            with open(self._cache_path) as fp:
+                self._hashes = json.load(fp).get('hashes', {})  # abspath -> [mtime, size, digest]
+        except (IOError, OSError, ValueError):
+            self._hashes = {}
+
+    def save(self):
+        with self._lock:
+            data = json.dumps({'hashes': self._hashes})
+        tmp = self._cache_path + '.tmp'
+        with open(tmp, 'w') as fp:
+            fp.write(data)
+        os.rename(tmp, self._cache_path)
+
+    def update(self, images=None):
+        """
+        Hashes every image whose master is new or has changed since it was last hashed.
+        :param [iphoto.iPhotoImage] images: defaults to every image in the library
+        :return: number of files hashed
+        :rtype: int
+        """
+        if images is None:
+            images = self._library.generation.images
+        stale = []
+        for image in images:
+            if image is None:
+                continue
+            path = image.abspath
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            known = self._hashes.get(path)
+            if known is None or known[0] != st.st_mtime or known[1] != st.st_size:
+                stale.append((path, st))
+
+        if stale:
+            if self.verbose:
+                print("hashing {} files".format(len(stale)))
+            paths = [path for path, _ in stale]
+            if len(stale) == 1:  # Not worth starting a pool for
+                digests = [hash_file(paths[0])]
+            else:
+                with ThreadPoolExecutor(max_workers=min(self._workers, len(stale))) as pool:
+                    digests = list(pool.map(hash_file, paths))
+            with self._lock:
+                for (path, st), digest in zip(stale, digests):
+                    if digest is not None:
+                        self._hashes[path] = [st.st_mtime, st.st_size, digest]
+            self.save()
+        return len(stale)
+
+    def digest(self, image):
+        """
+        Returns the content digest of an image's master, hashing it first if necessary.
+        :param iphoto.iPhotoImage image: the image
+        :rtype: str
+        """
+        self.update([image])
+        known = self._hashes.get(image.abspath)
+        return known[2] if known is not None else None
+
+    def duplicates(self, images=None):
+        """
+        Groups images whose masters are byte-for-byte identical.
+        :param [iphoto.iPhotoImage] images: defaults to every image in the library
+        :return: digest -> images with that content, only for digests shared by two or more images
+        :rtype: OrderedDict
+        """
+        if images is None:
+            images = self._library.generation.images
+        images = [i for i in images if i is not None]
+        self.update(images)
+        by_digest = {}
+        for image in images:
+            known = self._hashes.get(image.abspath)
+            if known is not None:
+                by_digest.setdefault(known[2], []).append(image)
+        return OrderedDict((d, by_digest[d]) for d in sorted(by_digest) if len(by_digest[d]) > 1)
+
+
+def find_duplicates(library, workers=None, verbose=False):
+    """
+    Returns groups of images in a library whose masters are identical.
+    :param iphoto.iPhotoLibrary library: the library
+    :param int workers: number of hashing threads
+    :return: digest -> [iPhotoImage]
+    :rtype: OrderedDict
+    """
+    return ContentIndex(library, workers=workers, verbose=verbose).duplicates()
+
+
+def main():
+    if len(sys.argv) < 2:
+        print('usage: %s iphotolibrary' % sys.argv[0])
+        print("""
+            Lists groups of photos whose masters are byte-for-byte identical.
+        """)
+        exit(1)
+    lib = iPhotoLibrary(sys.argv[1])
+    for digest, images in find_duplicates(lib, verbose=True).items():
+        print(digest)
+        for image in images:
+            print('\t', image.relpath)
+
+
+if __name__ == '__main__':
+    main()
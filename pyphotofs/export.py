@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# Python 3, or Python 2 with the futures backport (kernel-side copies need Python 3.3+, 3.8+ for copy_file_range)
+"""
+Copies masters out of an iPhoto library without going through a FUSE mount.
+
+Files are copied by a pool of worker threads using copy_file_range() or
+sendfile() where the platform has them, so the data never passes through
+Python.  A file whose destination already has the same size and
+modification time is skipped, so an interrupted export can simply be rerun.
+"""
+from __future__ import print_function
+
+import errno
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from iphoto import *
+
+__author__ = "Robert Harder"
+__email__ = "rob@iharder.net"
+__copyright__ = "This code is released into the Public Domain"
+__version__ = "0.1"
+__status__ = "Development"
+
+_COPY_CHUNK = 8 * 1024 * 1024
+
+
+def _copy_kernel(src_fd, dst_fd, size):
+    """
+    Copies size bytes between two file descriptors inside the kernel.
+    :return: False if neither copy_file_range nor sendfile is usable here
+    :rtype: bool
+    :raises IOError: if the source ends before size bytes have been copied
+    """
+    copied = 0
+    for func in (getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)):
+        if func is None:
+            continue
+        try:
+            while copied < size:
+                if func is os.sendfile:
+                    n = func(dst_fd, src_fd, copied, min(_COPY_CHUNK, size - copied))
+                else:
+                    n = func(src_fd, dst_fd, min(_COPY_CHUNK, size - copied), copied, copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError as e:
+            # Unsupported across these filesystems or (macOS sendfile) to a non-socket
+            if copied or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                         errno.EOPNOTSUPP, errno.ENOTSOCK, errno.EBADF):
+                raise
+            continue
+        if copied == size:
+            return True
+        if copied:
+            raise IOError(errno.EIO, "Source ended after {} of {} bytes".format(copied, size))
+        # Nothing copied at all: some filesystems answer 0 rather than an error; try the next way
+    return False
+
+
+def copy_file(src, dst):
+    """
+    Copies src to dst with a kernel-side copy if possible, preserving the
+    modification time so that a later export can tell the file is unchanged.
+    Nothing is left at dst unless all of src was copied.
+    :return: number of bytes copied
+    :rtype: int
+    """
+    st = os.stat(src)
+    tmp = dst + '.part'
+    try:
+        with open(src, 'rb') as fsrc:
+            with open(tmp, 'wb') as fdst:
+                if not _copy_kernel(fsrc.fileno(), fdst.fileno(), st.st_size):
+                    shutil.copyfileobj(fsrc, fdst, _COPY_CHUNK)
+                fdst.flush()
+                if os.fstat(fdst.fileno()).st_size != st.st_size:
+                    raise IOError(errno.EIO, "{} changed size while being copied".format(src))
+        os.utime(tmp, (st.st_atime, st.st_mtime))
+        os.rename(tmp, dst)
+    except (IOError, OSError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return st.st_size
+
+
+def is_up_to_date(src, dst):
+    """
+    Whether dst already has src's size and modification time.
+    :rtype: bool
+    """
+    try:
+        s, d = os.stat(src), os.stat(dst)
+    except OSError:
+        return False
+    return s.st_size == d.st_size and int(s.st_mtime) == int(d.st_mtime)
+
+
+class ExportReport(object):
+    """
+    Running totals for an export.  Updated from the worker threads.
+    """
+
+    def __init__(self):
+        self.copied = 0
+        self.skipped = 0
+        self.failed = []  # (source path, error message)
+        self.bytes_copied = 0
+        self.started = time.time()
+        self.finished = None
+        self._lock = Lock()
+
+    def __str__(self):
+        elapsed = self.elapsed
+        rate = human_size(self.bytes_copied / elapsed) + '/s' if elapsed > 0 else 'n/a'
+        return "[Export copied={}, skipped={}, failed={}, {} in {:.1f}s, {}]".format(
+            self.copied, self.skipped, len(self.failed), human_size(self.bytes_copied), elapsed, rate)
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def throughput(self):
+        """Bytes per second copied so far."""
+        return self.bytes_copied / self.elapsed if self.elapsed > 0 else 0
+
+    def _add(self, copied=0, skipped=0, nbytes=0, failure=None):
+        with self._lock:
+            self.copied += copied
+            self.skipped += skipped
+            self.bytes_copied += nbytes
+            if failure is not None:
+                self.failed.append(failure)
+
+
+def _export_jobs(collections, destination):
+    """
+    Yields (source, destination) pairs for the images in the collections.
+    Images with the same file name in one collection are told apart by GUID,
+    as in the mount's Duplicates folder, so no two copies share a destination.
+    """
+    for folder, collection in collections:
+        dest_dir = os.path.join(destination, folder)
+        if not os.path.isdir(dest_dir):
+            os.makedirs(dest_dir)
+        names = set()
+        for image in collection.images:
+            if image is not None:
+                name = image.filename
+                if name in names:
+                    base, ext = os.path.splitext(name)
+                    name = '{} ({}){}'.format(base, image.guid, ext)
+                names.add(name)
+                yield image.abspath, os.path.join(dest_dir, name)
+
+
+def export(collections, destination, workers=8, verbose=False):
+    """
+    Copies the masters of the given collections to destination.
+    :param [(str, iphoto.iPhotoCollection)] collections: pairs of destination
+                    subfolder (eg, 'Albums/Boats') and collection to put there
+    :param str destination: folder to export into
+    :param int workers: number of files to copy at once
+    :return: totals for the export
+    :rtype: ExportReport
+    """
+    report = ExportReport()
+
+    def copy_one(job):
+        src, dst = job
+        try:
+            if is_up_to_date(src, dst):
+                report._add(skipped=1)
+            else:
+                report._add(copied=1, nbytes=copy_file(src, dst))
+                if verbose:
+                    print("copied", dst, str(report))
+        except (IOError, OSError) as e:
+            report._add(failure=(src, str(e)))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for _ in pool.map(copy_one, _export_jobs(collections, destination)):
+            pass
+    report.finished = time.time()
+    return report
+
+
+def export_collection(collection, destination, workers=8, verbose=False):
+    """
+    Copies the masters of one album or roll into destination.
+    :param iphoto.iPhotoCollection collection: the album or roll
+    :param str destination: folder to copy the images into
+    :rtype: ExportReport
+    """
+    return export([('', collection)], destination, workers=workers, verbose=verbose)
+
+
+def export_library(library, destination, c_types=('Albums', 'Rolls'), workers=8, verbose=False):
+    """
+    Copies every album and/or roll of a library into destination/Albums/<name>
+    and destination/Rolls/<name>, mirroring the mounted layout.
+    :param iphoto.iPhotoLibrary library: the library
+    :param str destination: folder to export into
+    :param [str] c_types: which kinds of collection to export
+    :rtype: ExportReport
+    """
+    lib = library.generation
+    collections = [(os.path.join(c_type, c.name), c) for c_type in c_types for c in lib.collections(c_type)]
+    return export(collections, destination, workers=workers, verbose=verbose)
+
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith('-j')]
+    jobs = [int(a[2:]) for a in sys.argv[1:] if a.startswith('-j')]
+    if len(args) < 2:
+        print('usage: %s iphotolibrary destination [Albums/Name|Rolls/Name ...] [-jN]' % sys.argv[0])
+        print("""
+            Copies masters out of the library into destination, laid out as
+            Albums/<name>/... and Rolls/<name>/... just like the mounted library.
+            Name particular albums or rolls to export only those.  Files already
+            exported with the same size and modification time are skipped.
+            -jN copies N files at once (default 8).
+        """)
+        exit(1)
+
+    lib = iPhotoLibrary(args[0]).generation
+    if len(args) > 2:
+        collections = []
+        for c_path in args[2:]:
+            c_type, _, name = c_path.strip('/').partition('/')
+            collection = lib.collection(c_type, name)
+            if collection is None:
+                print("No such album or roll:", c_path, file=sys.stderr)
+                exit(1)
+            collections.append((os.path.join(c_type, name), collection))
+        report = export(collections, args[1], workers=jobs[-1] if jobs else 8)
+    else:
+        report = export_library(lib, args[1], workers=jobs[-1] if jobs else 8)
+
+    print(str(report))
+    for src, error in report.failed:
+        print("failed:", src, error, file=sys.stderr)
+    exit(1 if report.failed else 0)
+
+
+if __name__ == '__main__':
+    main()
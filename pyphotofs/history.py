@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# Should work with Python 2 or 3
+"""
+Reads the change journal iPhoto keeps in Database/History/Changes.
+
+Every time iPhoto commits a change to its database it writes the next
+numbered plist there (0000000001.plist, 0000000002.plist, ...), listing
+which rows of which tables were inserted, updated or deleted.  The journal
+names what changed but not the new values, so only changes whose new
+values can be read cheaply from elsewhere are applied incrementally:
+updates to a version (caption, rating) are re-read from that version's
+small .apversion plist.  Changes to tables that AlbumData.xml doesn't
+reflect at all are skipped, and anything else means the whole library has
+to be parsed again.
+"""
+import os
+
+try:
+    from .iphoto import read_plist
+except (ImportError, ValueError):  # Not imported as part of the pyphotofs package
+    from iphoto import read_plist
+
+__author__ = "Robert Harder"
+__email__ = "rob@iharder.net"
+__copyright__ = "This code is released into the Public Domain"
+__version__ = "0.1"
+__status__ = "Development"
+
+CHANGE_INSERTED = 1
+CHANGE_UPDATED = 2
+CHANGE_DELETED = 3
+
+# Tables whose rows never show up in AlbumData.xml as we read it.  Keywords do (each
+# image's Keywords and the List of Keywords, which smart albums search), so changes to
+# them are left to a full reload.
+_IGNORED_TABLES = frozenset([
+    'RKRepair', 'RKImageProxyStateChange',
+    'RKDetectedFaceChange', 'RKDetectedFaceExternalChange', 'RKFaceNameChange', 'RKFaceExternalChange',
+    'RKPlaceForVersionChange', 'RKStackStateChange', 'RKStackEntryChange', 'RKVaultChange',
+    'RKCustomSortEntryChange', 'RKAttachmentChange',
+])
+_VERSION_TABLE = 'RKVersionChange'
+
+
+class JournalIncomplete(Exception):
+    """
+    The journal doesn't account for everything that changed, so the
+    library has to be parsed again from scratch.
+    """
+    pass
+
+
+class ChangeJournal(object):
+    """
+    The numbered change plists of one library.
+    """
+
+    def __init__(self, library_path):
+        """
+        :param str library_path: path to the .photolibrary folder
+        """
+        self._library_path = library_path
+        self._changes_dir = os.path.join(library_path, 'Database', 'History', 'Changes')
+
+    def __str__(self):
+        return "[ChangeJournal {}]".format(self._changes_dir)
+
+    @property
+    def mtime(self):
+        """
+        Modification time of the journal folder, which changes whenever a
+        change is added, or None if there is no journal.
+        :rtype: float
+        """
+        try:
+            return os.stat(self._changes_dir).st_mtime
+        except OSError:
+            return None
+
+    def numbers(self):
+        """
+        Returns the numbers of the changes in the journal, in order.
+        :rtype: [int]
+        """
+        numbers = []
+        try:
+            names = os.listdir(self._changes_dir)
+        except OSError:
+            return numbers
+        for name in names:
+            base, ext = os.path.splitext(name)
+            if ext == '.plist' and base.isdigit():
+                numbers.append(int(base))
+        return sorted(numbers)
+
+    def latest(self):
+        """
+        Returns the number of the most recent change, or 0 if there is no journal.
+        :rtype: int
+        """
+        numbers = self.numbers()
+        return numbers[-1] if numbers else 0
+
+    def changes_since(self, number):
+        """
+        Reads every change made after the given one.
+        :param int number: the last change already applied
+        :return: the number of the last change read, and the rows that changed
+        :rtype: (int, [dict])
+        :raises JournalIncomplete: if there is no journal or some of it is missing
+        """
+        numbers = [n for n in self.numbers() if n > number]
+        if not numbers and self.mtime is None:
+            raise JournalIncomplete("{} has no change journal".format(self._library_path))
+        if numbers and numbers != list(range(number + 1, numbers[-1] + 1)):
+            raise JournalIncomplete("changes after {} are missing from {}".format(number, self))
+        entries = []
+        for n in numbers:
+            try:
+                with open(os.path.join(self._changes_dir, '{:010d}.plist'.format(n)), 'rb') as fp:
+                    entries.extend(read_plist(fp))
+            except Exception as e:
+                raise JournalIncomplete("change {} is unreadable: {}".format(n, e))
+        return (numbers[-1] if numbers else number), entries
+
+
+def updated_versions(entries):
+    """
+    Returns the uuids of the versions whose captions or ratings may have changed.
+    A version's uuid is the GUID of its image in AlbumData.xml.
+    :param [dict] entries: rows from ChangeJournal.changes_since
+    :rtype: set
+    :raises JournalIncomplete: if anything else changed that the library would need to know about
+    """
+    uuids = set()
+    for entry in entries:
+        table = entry.get('table')
+        if table in _IGNORED_TABLES:
+            continue
+        if table == _VERSION_TABLE and entry.get('changeType') == CHANGE_UPDATED:
+            uuids.add(entry.get('changeUuid'))
+            continue
+        raise JournalIncomplete("can't apply {} change {} to {}".format(
+            table, entry.get('changeType'), entry.get('changeUuid')))
+    return uuids
+
+
+def read_versions(library_path, images):
+    """
+    Reads the .apversion plists of some images.  Versions are filed under the
+    same import group as their masters, so only those groups' folders are searched.
+    :param str library_path: path to the .photolibrary folder
+    :param [iphoto.iPhotoImage] images: the images
+    :return: GUID -> the image's version plist
+    :rtype: dict
+    :raises JournalIncomplete: if any of the versions can't be found
+    """
+    guids_by_group = {}
+    for image in images:
+        master = image.relpath
+        if master is None or not master.startswith('Masters' + os.sep):
+            raise JournalIncomplete("{} is a referenced master".format(image.declared_image_path))
+        group = os.path.dirname(os.path.relpath(master, 'Masters'))
+        guids_by_group.setdefault(group, set()).add(image.guid)
+
+    versions = {}
+    for group, guids in guids_by_group.items():
+        group_dir = os.path.join(library_path, 'Database', 'Versions', group)
+        for master_dir in (os.listdir(group_dir) if os.path.isdir(group_dir) else []):
+            for name in os.listdir(os.path.join(group_dir, master_dir)):
+                if not (name.startswith('Version-') and name.endswith('.apversion')):
+                    continue
+                with open(os.path.join(group_dir, master_dir, name), 'rb') as fp:
+                    version = read_plist(fp)
+                if version.get('uuid') in guids:
+                    versions[version['uuid']] = version
+        missing = guids.difference(versions)
+        if missing:
+            raise JournalIncomplete("no version plist for {} in {}".format(', '.join(sorted(missing)), group))
+    return versions
+
+
+def apply_version(img_plist, version):
+    """
+    Returns a copy of an image's entry from the Master Image List updated from its version plist.
+    :param dict img_plist: the image's entry in AlbumData.xml
+    :param dict version: its .apversion plist
+    :rtype: dict
+    """
+    img_plist = dict(img_plist)
+    if 'name' in version:
+        img_plist['Caption'] = version['name']
+    if 'mainRating' in version:
+        img_plist['Rating'] = version['mainRating']
+    return img_plist
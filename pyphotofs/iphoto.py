@@ -5,9 +5,13 @@ Should work with Python 2.7 and 3.0+
 """
 
 import datetime
+import hashlib
 import math
 import os
 import plistlib
+import time
+from collections import OrderedDict
+from threading import Event, Lock, Thread
 
 __author__ = "Robert Harder"
 __email__ = "rob@iharder.net"
@@ -16,17 +20,123 @@ __version__ = "0.1"
 __status__ = "Development"
 
 
+class LibraryNotLoaded(Exception):
+    """
+    Raised when a library that is loading in the background is not ready in time.
+    """
+    pass
+
+
+def read_plist(fp):
+    """
+    Reads a plist from a file object with whichever plistlib API this Python has.
+    """
+    if hasattr(plistlib, 'load'):
+        return plistlib.load(fp)
+    return plistlib.readPlist(fp)
+
+
+class _ProgressReader(object):
+    """
+    Wraps a file object and counts how many bytes have been read from it.
+    """
+
+    def __init__(self, fp):
+        self._fp = fp
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self._fp.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def seek(self, *args):
+        result = self._fp.seek(*args)
+        self.bytes_read = self._fp.tell()
+        return result
+
+    def __getattr__(self, name):  # tell() and so on
+        return getattr(self._fp, name)
+
+
+class CacheBudget(object):
+    """
+    A memory budget shared by several caches and libraries.  Costs are counted
+    in cached objects (images, stat dictionaries, listings) rather than bytes,
+    which is a close enough proxy since those are all of similar size.
+    When the total goes over budget, the least recently used owners are evicted
+    by way of the callback they registered.
+    """
+
+    def __init__(self, max_entries=250000, verbose=False):
+        self.max_entries = max_entries
+        self.verbose = verbose
+        self._owners = OrderedDict()  # owner -> [cost, evict callback], least recently used first
+        self._total = 0
+        self._lock = Lock()
+
+    def __str__(self):
+        return "[CacheBudget {}/{} entries, {} owners]".format(self._total, self.max_entries, len(self._owners))
+
+    @property
+    def total(self):
+        return self._total
+
+    def charge(self, owner, cost, evict):
+        """
+        Adds cost to owner's share of the budget, marks owner as recently used
+        and evicts other owners if the budget is exceeded.
+        :param owner: any hashable object, typically a Cache or iPhotoLibrary
+        :param int cost: number of entries to add
+        :param evict: called with no arguments if owner is chosen for eviction
+        """
+        victims = []
+        with self._lock:
+            entry = self._owners.pop(owner, None) or [0, evict]
+            entry[0] += cost
+            self._owners[owner] = entry
+            self._total += cost
+            while self._total > self.max_entries and len(self._owners) > 1:
+                victim = next(iter(self._owners))
+                if victim is owner:
+                    break
+                victim_cost, victim_evict = self._owners.pop(victim)
+                self._total -= victim_cost
+                victims.append(victim_evict)
+
+        # Evict outside the lock since callbacks may call back into the budget
+        for victim_evict in victims:
+            if self.verbose:
+                print("budget evicting", victim_evict, str(self))
+            victim_evict()
+
+    def touch(self, owner):
+        """Marks owner as recently used."""
+        with self._lock:
+            entry = self._owners.pop(owner, None)
+            if entry is not None:
+                self._owners[owner] = entry
+
+    def release(self, owner):
+        """Returns all of owner's share of the budget."""
+        with self._lock:
+            entry = self._owners.pop(owner, None)
+            if entry is not None:
+                self._total -= entry[0]
+
+
 class Cache(object):
     """
     Used internally to cache filesystem data to avoid constantly re-reading of AlbumData.xml.
     """
 
-    def __init__(self, mtime_file=None, cache_timeout_seconds=1, verbose=False):
+    def __init__(self, mtime_file=None, cache_timeout_seconds=1, verbose=False, budget=None):
         # self._time_until_flush = datetime.timedelta(seconds=cache_timeout_seconds)
         self.verbose = verbose
         self._cache = {}
+        self._budget = budget  # Optional CacheBudget shared with other caches
         self._time_until_flush_check = datetime.timedelta(
-            seconds=cache_timeout_seconds)  # In busy times, don't bother checking mtime
+            seconds=cache_timeout_seconds) if cache_timeout_seconds is not None else None  # None: never flush
         self._mtime_file = mtime_file  # File who's modification time will determine cache staleness
         if mtime_file:
             self._last_mtime = os.stat(self._mtime_file).st_mtime  # Previously-known mtime
@@ -35,23 +145,54 @@ class Cache(object):
     def __str__(self):
         return "[Cache based on {}]".format(self._mtime_file)
 
+    def flush(self):
+        """
+        Empties the cache and returns its share of any shared budget.
+        """
+        self._cache = {}
+        if self._budget is not None:
+            self._budget.release(self)
+        if self.verbose:
+            print("cache flushed", str(self))
+
     def _test_for_flush(self):
         """
         Checks to see if cache should be flushed based on either a change in an underlying file
         or if enough time has passed.
         """
+        if self._time_until_flush_check is None:
+            return
         now = datetime.datetime.utcnow()
         if now - self._last_access > self._time_until_flush_check:  # Have we had a delay since the last access
             if self._mtime_file is None:
-                self._cache = {}
-                if self.verbose:
-                    print("cache flushed", str(self))
+                self.flush()
             elif os.stat(self._mtime_file).st_mtime > self._last_mtime:
-                self._cache = {}  # Cache flushed
-                if self.verbose:
-                    print("cache flushed", str(self))
+                self.flush()  # Cache flushed
         self._last_access = now
 
+    def copy_domains(self, other, domains):
+        """
+        Copies whole domains into another cache, charging them to its budget.
+        :param Cache other: the cache to copy into
+        :param [str] domains: the domains to copy, where present
+        """
+        for domain in domains:
+            if domain in self._cache:
+                value = self._cache[domain]
+                value = dict(value) if isinstance(value, dict) else value
+                if other._budget is not None:
+                    other._budget.charge(other, len(value) if isinstance(value, dict) else 1, other.flush)
+                other._cache[domain] = value
+
+    def sizes(self):
+        """
+        Returns how many entries each domain holds.
+        :rtype: OrderedDict
+        """
+        cache = self._cache
+        return OrderedDict((domain, len(value) if isinstance(value, (dict, list)) else 1)
+                           for domain, value in sorted(cache.items()))
+
     def get(self, domain, key=None, default=None):
         self._test_for_flush()
 
@@ -89,6 +230,15 @@ class Cache(object):
 
         if self.verbose:
             print("cache set domain={}, key={}, value={}".format(domain, key, value), str(self))
+        if self._budget is not None:
+            if value is None:
+                new = domain not in self._cache
+            else:
+                new = key not in self._cache.get(domain, ())
+            if new:
+                self._budget.charge(self, 1, self.flush)
+            else:  # Replacing an entry already paid for
+                self._budget.touch(self)
 
         # If value is None, that means we're setting an item
         # directly in the cache as opposed to a dictionary
@@ -118,19 +268,273 @@ class iPhotoLibrary(object):
     _ck_numCollectionsByType = '_ck_numCollectionsByType'
     _ck_childCaches = '_ck_childCaches'
     _ck_masterImageList = '_ck_masterImageList'
+    _ck_albumNamesByGuid = '_ck_albumNamesByGuid'
+    _ck_smartAlbums = '_ck_smartAlbums'
+    _ck_smartAlbumResults = '_ck_smartAlbumResults'
+    _ck_metadataTable = '_ck_metadataTable'
+
+    # Domains that only depend on which albums and rolls there are and what is in
+    # them, and so survive a change to an image's caption or rating
+    _ck_portable = (_ck_collectionNamesByType, _ck_numCollectionsByType, _ck_albumNamesByGuid)
 
-    def __init__(self, library_path, verbose=False):
+    # Smart album definitions, which a journal update never changes, and results,
+    # which are checked against the attributes their queries test before reuse
+    _ck_smart_portable = (_ck_smartAlbums, _ck_smartAlbumResults)
+
+    def __init__(self, library_path, verbose=False, budget=None, background=False, load_timeout=None):
+        """
+        :param str library_path: path to the .photolibrary folder
+        :param iphoto.CacheBudget budget: optional memory budget shared with other libraries
+        :param bool background: parse AlbumData.xml on a background thread instead of here
+        :param float load_timeout: while loading in the background, how long a caller
+                                   will wait for the library before LibraryNotLoaded is raised
+        """
 
         # self._albumDataStMTime = None
         self._libraryPath = os.path.normpath(library_path)
         self._album_data_xml = os.path.join(self._libraryPath, 'AlbumData.xml')
-        self._plist = plistlib.readPlist(self._album_data_xml)
-        self._cache = Cache(mtime_file=self._album_data_xml, verbose=verbose)
+        self._budget = budget
         self.verbose = verbose
 
+        try:
+            from .history import ChangeJournal
+        except (ImportError, ValueError):  # Not imported as part of the pyphotofs package
+            from history import ChangeJournal
+        self._journal = ChangeJournal(self._libraryPath)
+        self._journal_mtime = self._journal.mtime
+        self.portable_cache_domains = set(self._ck_portable)  # Others' domains may be added
+
+        self._generation = None  # The current iPhotoLibraryGeneration, swapped whole on reload
+        self._generation_number = 0
+        self._reload_lock = Lock()  # Only one reload builds a generation at a time
+        self._reloading = False  # Whether an update has been started and not yet finished
+        self._reloading_lock = Lock()
+        self._mtime_check_interval = 1  # In busy times, don't bother checking mtime
+        self._last_mtime_check = time.time()
+
+        self._load_error = None
+        self._load_timeout = load_timeout
+        self._loaded = Event()
+        self._load_started = time.time()
+        self._load_finished = None
+        self._load_total = os.path.getsize(self._album_data_xml)
+        self._load_reader = None
+        if background:
+            loader = Thread(target=self._load, name='iphoto-load ' + self.name)
+            loader.daemon = True
+            loader.start()
+        else:
+            self._load()
+            if self._load_error is not None:
+                raise self._load_error
+
     def __str__(self):
         return "[iPhoto Library '{}']".format(self.name)
 
+    def _load(self):
+        """
+        Parses AlbumData.xml, keeping track of how far along the parse is.
+        """
+        try:
+            mtime = os.stat(self._album_data_xml).st_mtime
+            change_number = self._journal.latest()  # Before parsing, so nothing is missed
+            with open(self._album_data_xml, 'rb') as fp:
+                self._load_reader = _ProgressReader(fp)
+                self._publish(read_plist(self._load_reader), mtime, change_number)
+        except Exception as e:
+            self._load_error = e
+        finally:
+            self._load_finished = time.time()
+            self._loaded.set()
+
+    def _publish(self, plist, mtime, change_number=0, carry_from=None):
+        """
+        Wraps a freshly parsed plist in a new generation and makes it current.
+        Readers still holding the previous generation keep using it until they finish,
+        at which point nothing refers to it any longer and it is reclaimed.
+        :param int change_number: the last change in the journal that plist reflects
+        :param iPhotoLibraryGeneration carry_from: a generation whose portable_cache_domains still hold,
+                                                   unless a smart album's contents have changed since
+        """
+        self._generation_number += 1
+        generation = iPhotoLibraryGeneration(self, plist, self._generation_number, mtime, budget=self._budget,
+                                             change_number=change_number)
+        if carry_from is not None:
+            carry_from.cache.copy_domains(generation.cache, self._ck_smart_portable)
+            if generation._same_smart_album_contents(carry_from):
+                carry_from.cache.copy_domains(generation.cache, self.portable_cache_domains)
+            elif self.verbose:
+                print("smart albums changed; not carrying listings over to generation", generation.number)
+        old = self._generation
+        self._generation = generation  # A single reference assignment, so readers see old or new, never a mix
+        if old is not None and self._budget is not None:
+            self._budget.release(old.cache)
+        if self.verbose:
+            print("published generation", generation.number, str(self))
+        return generation
+
+    def reload(self):
+        """
+        Parses AlbumData.xml again, off to the side, and publishes the result
+        as a new generation.
+        :return: the new generation
+        :rtype: iPhotoLibraryGeneration
+        """
+        with self._reload_lock:
+            try:
+                return self._reload()
+            finally:
+                self._reloading = False
+
+    def _reload(self):
+        mtime = os.stat(self._album_data_xml).st_mtime
+        change_number = self._journal.latest()
+        with open(self._album_data_xml, 'rb') as fp:
+            return self._publish(read_plist(fp), mtime, change_number)
+
+    def update(self):
+        """
+        Brings the library up to date by applying just the changes recorded in
+        its journal since the current generation was built, falling back to
+        parsing AlbumData.xml again if the journal doesn't account for them.
+        iPhoto journals each change as it is made but rewrites AlbumData.xml
+        only now and then, so a rewrite with nothing new in the journal is
+        still parsed in full: it may hold changes made by something else.
+        :return: the new generation
+        :rtype: iPhotoLibraryGeneration
+        """
+        try:
+            from .history import JournalIncomplete, updated_versions, read_versions, apply_version
+        except (ImportError, ValueError):
+            from history import JournalIncomplete, updated_versions, read_versions, apply_version
+        with self._reload_lock:
+            try:
+                current = self._generation
+                try:
+                    # Stat before reading the journal: iPhoto rewrites AlbumData.xml as it journals
+                    # each change, so the rewrite seen here is accounted for by the entries read next
+                    mtime = os.stat(self._album_data_xml).st_mtime
+                    change_number, entries = self._journal.changes_since(current.change_number)
+                    if not entries:
+                        raise JournalIncomplete("AlbumData.xml changed but the journal didn't")
+                    guids = updated_versions(entries)
+                except (JournalIncomplete, OSError) as e:
+                    if self.verbose:
+                        print("full reload:", e)
+                    return self._reload()
+
+                plist = current._plist
+                if guids:
+                    images = dict(plist.get('Master Image List', {}))
+                    changed = dict((img_id, img_plist) for img_id, img_plist in images.items()
+                                   if img_plist.get('GUID') in guids)
+                    try:
+                        versions = read_versions(self.abspath, [iPhotoImage(p, current) for p in changed.values()])
+                    except (JournalIncomplete, IOError, OSError) as e:
+                        if self.verbose:
+                            print("full reload:", e)
+                        return self._reload()
+                    for img_id, img_plist in changed.items():
+                        images[img_id] = apply_version(img_plist, versions[img_plist['GUID']])
+                    plist = dict(plist)
+                    plist['Master Image List'] = images
+                if self.verbose:
+                    print("applied changes {}-{} to {} images".format(
+                        current.change_number + 1, change_number, len(guids)))
+                # Any later rewrite of AlbumData.xml has a newer mtime and is still noticed
+                return self._publish(plist, mtime, change_number, carry_from=current)
+            finally:
+                self._reloading = False
+
+    def _check_for_changes(self):
+        """
+        Starts a background update if AlbumData.xml or the change journal has changed
+        since the current generation was built.  Checks at most once every
+        _mtime_check_interval seconds.
+        """
+        now = time.time()
+        if now - self._last_mtime_check < self._mtime_check_interval:
+            return
+        self._last_mtime_check = now
+        try:
+            mtime = os.stat(self._album_data_xml).st_mtime
+        except OSError:
+            return  # Mid-save perhaps; keep serving what we have
+        journal_mtime = self._journal.mtime
+        if mtime != self._generation.mtime or journal_mtime != self._journal_mtime:
+            with self._reloading_lock:  # Only one caller starts an update
+                if self._reloading:
+                    return
+                self._reloading = True
+            self._journal_mtime = journal_mtime
+            reloader = Thread(target=self.update, name='iphoto-update ' + self.name)
+            reloader.daemon = True
+            reloader.start()
+
+    @property
+    def generation(self):
+        """
+        Returns the current generation of the library: an immutable snapshot
+        whose collections, images and cache all belong to it alone.  Hold on to
+        one generation for the length of an operation to get a consistent view.
+        :rtype: iPhotoLibraryGeneration
+        """
+        if not self._loaded.wait(self._load_timeout):
+            raise LibraryNotLoaded("{} is still loading".format(self))
+        if self._load_error is not None:
+            raise self._load_error
+        self._check_for_changes()
+        return self._generation
+
+    @property
+    def _plist(self):
+        return self.generation._plist
+
+    @property
+    def _cache(self):
+        return self.generation.cache
+
+    @property
+    def is_loaded(self):
+        """
+        Whether AlbumData.xml has been parsed (or failed to parse).
+        :rtype: bool
+        """
+        return self._loaded.is_set()
+
+    def wait_until_loaded(self, timeout=None):
+        """
+        Blocks until the library has been loaded.
+        :param float timeout: seconds to wait, or None to wait indefinitely
+        :return: whether the library is loaded
+        :rtype: bool
+        """
+        return self._loaded.wait(timeout)
+
+    def load_status(self):
+        """
+        Describes the progress of loading the library.
+        :return: state ('loading', 'loaded' or 'failed'), bytes parsed, total bytes, and so on
+        :rtype: OrderedDict
+        """
+        status = OrderedDict()
+        status['library'] = self.abspath
+        if not self.is_loaded:
+            status['state'] = 'loading'
+        elif self._load_error is not None:
+            status['state'] = 'failed'
+            status['error'] = str(self._load_error)
+        else:
+            status['state'] = 'loaded'
+        bytes_read = self._load_reader.bytes_read if self._load_reader is not None else 0
+        status['bytes_read'] = bytes_read
+        status['bytes_total'] = self._load_total
+        status['progress'] = '{:.1f}%'.format(100.0 * bytes_read / self._load_total if self._load_total else 100.0)
+        status['elapsed_seconds'] = round((self._load_finished or time.time()) - self._load_started, 3)
+        status['generation'] = self._generation_number
+        status['change_number'] = self._generation.change_number if self._generation is not None else None
+        return status
+
     @property
     def cache(self):
         return self._cache
@@ -160,6 +564,24 @@ class iPhotoLibrary(object):
         """
         return os.path.abspath(self._libraryPath)
 
+    @property
+    def cache_dir(self):
+        """Returns a folder, outside the library, for caches that persist between runs.
+        The library itself is never written to.
+        :return: the absolute path to the folder, which is created if necessary
+        :rtype: str
+        """
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        digest = hashlib.sha1(self.abspath.encode('utf-8')).hexdigest()[:12]
+        path = os.path.join(base, 'pyphotofs', '{}-{}'.format(self.name, digest))
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+        return path
+
     ###
 
     def collections(self, c_type):
@@ -178,6 +600,12 @@ class iPhotoLibrary(object):
         else:
             if c_type == 'Albums':
                 coll_list = [iPhotoAlbum(plist, self) for plist in self._plist.get('List of ' + c_type, [])]
+                guids = set(a.guid for a in coll_list)
+                names = set(a.name for a in coll_list)
+                for smart in self.smart_albums.values():  # Made since AlbumData.xml was last written
+                    if smart.uuid not in guids and smart.name not in names and smart.conditions is not None:
+                        coll_list.append(iPhotoAlbum({'AlbumName': smart.name, 'Album Type': 'Smart',
+                                                      'GUID': smart.uuid}, self))
             elif c_type == 'Rolls':
                 coll_list = [iPhotoRoll(plist, self) for plist in self._plist.get('List of ' + c_type, [])]
             else:
@@ -292,10 +720,7 @@ class iPhotoLibrary(object):
         if num is not None:
             return num
         else:
-            if 'List of ' + c_type in self._plist:
-                num = len(self._plist.get('List of ' + c_type, []))
-            else:
-                num = 0
+            num = len(self.collections(c_type))
             return self._cache.set(self._ck_numCollectionsByType, c_type, num)
 
     @property
@@ -363,6 +788,89 @@ class iPhotoLibrary(object):
             images = [self.image_from_id(img_id) for img_id in self._plist.get('Master Image List', {})]
             return self._cache.set(self._ck_masterImageList, images)
 
+    def album_names_containing(self, image):
+        """
+        Returns the names of the albums an image belongs to.
+        :param iPhotoImage image: the image
+        :return: list of album names
+        :rtype: [str]
+        """
+        index = self._cache.get(self._ck_albumNamesByGuid)
+        if index is None:
+            index = {}
+            for album in self.albums:
+                for img in album.images:
+                    if img is not None:
+                        index.setdefault(img.guid, []).append(album.name)
+            self._cache.set(self._ck_albumNamesByGuid, index)
+        return index.get(image.guid, [])
+
+    ###
+
+    @property
+    def smart_albums(self):
+        """
+        Returns the smart albums defined in Database/Albums, whether or not
+        AlbumData.xml lists them yet.
+        :return: uuid -> definition
+        :rtype: OrderedDict
+        """
+        albums = self._cache.get(self._ck_smartAlbums)
+        if albums is not None:
+            return albums
+        else:
+            try:
+                from .smartalbums import read_smart_albums
+            except (ImportError, ValueError):
+                from smartalbums import read_smart_albums
+            return self._cache.set(self._ck_smartAlbums, read_smart_albums(self.abspath))
+
+    @property
+    def metadata_table(self):
+        """
+        Returns the attributes smart album queries test, for every image in this generation.
+        :rtype: smartalbums.MetadataTable
+        """
+        table = self._cache.get(self._ck_metadataTable)
+        if table is not None:
+            return table
+        else:
+            try:
+                from .smartalbums import MetadataTable
+            except (ImportError, ValueError):
+                from smartalbums import MetadataTable
+            return self._cache.set(self._ck_metadataTable, MetadataTable(self.generation))
+
+    def smart_album_ids(self, uuid):
+        """
+        Works out which images are in a smart album now.  The answer from an
+        earlier generation is reused if none of the attributes the album's
+        query tests have changed since.
+        :param str uuid: the album's GUID
+        :return: image IDs, or None if there is no such smart album or its query can't be evaluated
+        :rtype: [str]
+        """
+        album = self.smart_albums.get(uuid)
+        if album is None or album.conditions is None:
+            return None
+        table = self.metadata_table
+        digests = table.digests(album.columns)
+        found = self._cache.get(self._ck_smartAlbumResults, uuid)
+        if found is not None and found[0] == digests:
+            return found[1]
+        ids = table.select(album.conditions)
+        self._cache.set(self._ck_smartAlbumResults, uuid, (digests, ids))
+        return ids
+
+    def _same_smart_album_contents(self, other):
+        """
+        Whether every smart album that was evaluated in another generation has the same images in this one.
+        """
+        for uuid, (_, ids) in list(other.cache.get(self._ck_smartAlbumResults, default={}).items()):
+            if self.smart_album_ids(uuid) != ids:
+                return False
+        return True
+
     @property
     def num_images(self):
         """
@@ -373,11 +881,69 @@ class iPhotoLibrary(object):
         return len(self._plist.get('Master Image List', []))
 
 
+class iPhotoLibraryGeneration(iPhotoLibrary):
+    """
+    One immutable snapshot of an iPhotoLibrary, as parsed from AlbumData.xml at
+    a particular modification time.  Collections and images obtained from a
+    generation refer back to it rather than to the live library, and its cache
+    is never flushed for staleness since the data under it never changes.
+    """
+
+    def __init__(self, library, plist, number, mtime, budget=None, change_number=0):
+        # Deliberately not calling iPhotoLibrary.__init__: everything is already loaded
+        self._library = library
+        self._libraryPath = library.path
+        self._album_data_xml = os.path.join(self._libraryPath, 'AlbumData.xml')
+        self._budget = budget
+        self._generation_plist = plist
+        self._generation_cache = Cache(cache_timeout_seconds=None, verbose=library.verbose, budget=budget)
+        self.number = number
+        self.mtime = mtime
+        self.change_number = change_number  # Last change in the journal this generation reflects
+        self.verbose = library.verbose
+
+    def __str__(self):
+        return "[iPhoto Library '{}' generation {}]".format(self.name, self.number)
+
+    @property
+    def library(self):
+        """
+        The live library this is a generation of.
+        :rtype: iPhotoLibrary
+        """
+        return self._library
+
+    @property
+    def generation(self):
+        return self
+
+    @property
+    def is_loaded(self):
+        return True
+
+    @property
+    def _plist(self):
+        return self._generation_plist
+
+    @property
+    def _cache(self):
+        return self._generation_cache
+
+    def reload(self):
+        return self._library.reload()
+
+    def update(self):
+        return self._library.update()
+
+    def load_status(self):
+        return self._library.load_status()
+
+
 class iPhotoCollection(object):
     """Not meant to be instantiated, only inherited"""
 
     _ck_collectionImagesByTypeName = '_ck_collectionImagesByTypeName'
-    _ck_imageByTypeNameFilename = '_ck_imageByTypeNameFilename'
+    _ck_imagesByFilenameByTypeName = '_ck_imagesByFilenameByTypeName'
 
     def __init__(self, albumPlist, parentLib, nameKey):
         self._parentLibrary = parentLib
@@ -416,27 +982,38 @@ class iPhotoCollection(object):
         if img_list is not None:
             return img_list
         else:
-            img_list = [self._parentLibrary.image_from_id(img_id) for img_id in self._plist.get('KeyList', [])]
+            img_list = [self._parentLibrary.image_from_id(img_id) for img_id in self._key_list()]
             return cache.set(self._ck_collectionImagesByTypeName, key, img_list)
 
     def image_by_filename(self, filename):
         """
         Returns the image (as an iPhotoImage object) with the given filename
-        within this collection.
+        within this collection.  The first lookup builds a filename index of the
+        whole collection so later lookups, hits or misses, don't scan it again.
         :param filename: The filename of the image
         :return: The image with the matching filename
         :rypte: iPhotoImage
         """
         cache = self.cache
-        key = self._nameKey + '::' + self.name + '::' + filename
-        image = cache.get(self._ck_imageByTypeNameFilename, key)
-        if image is not None:
-            return image
-        else:
-            for img_id in self._plist.get('KeyList', []):
-                image = self._parentLibrary.image_from_id(img_id)
-                if image is not None and image.filename == filename:
-                    return cache.set(self._ck_imageByTypeNameFilename, key, image)
+        key = self._nameKey + '::' + self.name
+        index = cache.get(self._ck_imagesByFilenameByTypeName, key)
+        if index is None:
+            index = {}
+            for image in self.images:
+                if image is not None and image.filename not in index:  # First one wins, as before
+                    index[image.filename] = image
+            cache.set(self._ck_imagesByFilenameByTypeName, key, index)
+        return index.get(filename)
+
+    def image_range(self, start, stop):
+        """
+        Returns the images at positions start up to (not including) stop within the
+        collection, in time proportional to the range rather than the collection.
+        :param int start: position of the first image, from 0
+        :param int stop: position after the last image
+        :rtype: [iPhotoImage]
+        """
+        return [self._parentLibrary.image_from_id(img_id) for img_id in self._key_list()[start:stop]]
 
     @property
     def num_images(self):
@@ -445,13 +1022,39 @@ class iPhotoCollection(object):
         :return: number of images
         :rtype: int
         """
-        return len(self._plist.get('KeyList', []))  # Not bothering to cache
+        return len(self._key_list())  # Not bothering to cache
+
+    @property
+    def image_ids(self):
+        """
+        Returns the IDs of the images in this collection, as keys into the Master Image List.
+        :rtype: [str]
+        """
+        return list(self._key_list())
+
+    def _key_list(self):
+        return self._plist.get('KeyList', [])
 
 
 class iPhotoAlbum(iPhotoCollection):
     def __init__(self, albumPlist, parentLib):
         super(iPhotoAlbum, self).__init__(albumPlist, parentLib, 'AlbumName')
 
+    @property
+    def guid(self):
+        return self._plist.get('GUID')
+
+    @property
+    def is_smart(self):
+        return self._plist.get('Album Type') == 'Smart'
+
+    def _key_list(self):
+        if self.is_smart:  # Evaluated afresh where possible, rather than as of AlbumData.xml
+            ids = self._parentLibrary.smart_album_ids(self.guid)
+            if ids is not None:
+                return ids
+        return self._plist.get('KeyList', [])
+
 
 class iPhotoRoll(iPhotoCollection):
     def __init__(self, albumPlist, parentLib):
@@ -478,16 +1081,32 @@ class iPhotoImage:
         then the actual file on disk could be found at
         /Volumes/iPhoto Libraries/2014-2018 Colorado.photolibrary/Masters/2014/07/07/20140707-235350/IMG_5348.JPG
         """
-        absImgPath = self._plist.get('ImagePath')
+        return self._library_relpath(self._plist.get('ImagePath'), 'Masters')
+
+    def _library_relpath(self, path, topFolder):
+        """Returns a path iPhoto recorded as relative to the library folder, or None if
+        it isn't inside a library.  If the library has been renamed since iPhoto last
+        wrote AlbumData.xml, the path is found by the topFolder (Masters or Thumbnails)
+        just inside whichever .photolibrary folder iPhoto recorded.
+        """
         libName = os.path.basename(self._parentLibrary.abspath)
-        return self._rel_internal_path_rel_path_recursive_helper(absImgPath, libName)
+        relpath = self._rel_internal_path_rel_path_recursive_helper(path, libName)
+        if relpath is None:
+            parts = path.split(os.sep)
+            for i in range(len(parts) - 2, 0, -1):
+                if parts[i] == topFolder and parts[i - 1].endswith('.photolibrary'):
+                    return os.path.join(*parts[i:])
+        return relpath
 
     def _rel_internal_path_rel_path_recursive_helper(self, path, targetFolder):
         leadingEl, lastEl = os.path.split(path)
         if lastEl == targetFolder:  # Found it!
             return ''
+        elif not lastEl or leadingEl == path:  # Reached the top without finding it
+            return None
         else:
-            return os.path.join(self._rel_internal_path_rel_path_recursive_helper(leadingEl, targetFolder), lastEl)
+            relpath = self._rel_internal_path_rel_path_recursive_helper(leadingEl, targetFolder)
+            return os.path.join(relpath, lastEl) if relpath is not None else None
 
     @property
     def declared_image_path(self):
@@ -502,15 +1121,39 @@ class iPhotoImage:
         """
         return self._plist.get('ImagePath')
 
+    @property
+    def relpath(self):
+        """Returns the path of the master relative to the library folder,
+        eg, Masters/2014/07/07/20140707-235350/IMG_5348.JPG, or None if the
+        master is referenced rather than copied into the library"""
+        return self._rel_internal_path()
+
     @property
     def abspath(self):
-        return os.path.join(self._parentLibrary.abspath, self._rel_internal_path())
+        relpath = self._rel_internal_path()
+        if relpath is None:  # Referenced; it stays where iPhoto found it
+            return self.declared_image_path
+        return os.path.join(self._parentLibrary.abspath, relpath)
 
     @property
     def thumbpath(self):
         # TODO: This needs to adapt just as the image path is hard coded in AlbumData.xml
         return self._plist.get('ThumbPath')
 
+    @property
+    def thumb_relpath(self):
+        """Returns the path of the thumbnail relative to the library folder,
+        eg, Thumbnails/2014/07/07/20140707-235350/<guid>/IMG_5348.JPG, or None if there isn't one"""
+        thumb = self._plist.get('ThumbPath')
+        if not thumb:
+            return None
+        return self._library_relpath(thumb, 'Thumbnails')
+
+    @property
+    def thumb_abspath(self):
+        relpath = self.thumb_relpath
+        return os.path.join(self._parentLibrary.abspath, relpath) if relpath is not None else None
+
     @property
     def caption(self):
         """Return the photo's caption"""
@@ -530,13 +1173,70 @@ class iPhotoImage:
     def guid(self):
         return self._plist.get('GUID')
 
+    @property
+    def comment(self):
+        """Return the photo's comment"""
+        return self._plist.get('Comment')
+
+    @property
+    def rating(self):
+        """Return the photo's star rating, 0 to 5"""
+        return self._plist.get('Rating', 0)
+
+    @property
+    def roll_id(self):
+        """Return the RollID of the roll (event) the photo was imported in"""
+        return self._plist.get('Roll')
+
+    @property
+    def date(self):
+        """Return the date the photo was taken, as a datetime"""
+        return apple_datetime(self._plist.get('DateAsTimerInterval'))
+
+    @property
+    def modified_date(self):
+        """Return the date the photo was last modified, as a datetime"""
+        return apple_datetime(self._plist.get('ModDateAsTimerInterval'))
+
     @property
     def size(self):
         return os.path.getsize(self.abspath)
 
 
+def find_libraries(parent):
+    """
+    Returns the paths of the iPhoto libraries directly within a folder.
+    :param str parent: the folder to search
+    :return: list of library paths
+    :rtype: [str]
+    """
+    return sorted(os.path.join(parent, f) for f in os.listdir(parent)
+                  if os.path.isfile(os.path.join(parent, f, 'AlbumData.xml')))
+
+
+def library_name(library_path):
+    """
+    The name iPhotoLibrary.name would report, without loading the library.
+    :param str library_path: path to the library
+    :rtype: str
+    """
+    base, _ = os.path.splitext(os.path.basename(os.path.normpath(library_path)))
+    return base
+
+
+def apple_datetime(interval):
+    """
+    Converts iPhoto's *AsTimerInterval values, seconds since 1 Jan 2001, to a datetime.
+    """
+    if interval is None:
+        return None
+    return datetime.datetime(2001, 1, 1) + datetime.timedelta(seconds=interval)
+
+
 def human_size(nbytes):
     suffixes = ['B', 'KB', 'MB', 'GB', 'TB', 'PB']
+    if nbytes < 1:
+        return '0 B'
     rank = int((math.log10(nbytes)) / 3)
     rank = min(rank, len(suffixes) - 1)
     human = nbytes / (1024.0 ** rank)
@@ -5,14 +5,16 @@ import shutil
 import sys
 import time
 import traceback
-from errno import ENOENT
+from collections import OrderedDict
+from errno import EAGAIN, EIO, ENOENT
 from platform import system
-from stat import S_IFDIR
-from threading import Lock
+from stat import S_IFDIR, S_IFREG
+from threading import Event, Lock, Thread
 
 from fuse import FuseOSError, Operations, LoggingMixIn, fuse_get_context, FUSE
 
 from iphoto import *
+from sidecars import SIDECAR_EXTENSION
 
 __author__ = "Robert Harder"
 __email__ = "rob@iharder.net"
@@ -21,15 +23,108 @@ __version__ = "0.1"
 __status__ = "Development"
 
 
+# Names that Finder, Explorer and desktop environments look for in every folder.
+# None of them is a photo or movie, which is all iPhoto imports, so they are
+# turned away unexamined.  Probes that could be photos (folder.jpg, say) are
+# looked up like any other name and end up in the negative cache instead.
+CLIENT_PROBE_NAMES = frozenset([
+    '.DS_Store', '.localized', '.hidden', '.Spotlight-V100', '.Trashes', '.fseventsd',
+    '.metadata_never_index', '.metadata_never_index_unless_rootfs', '.ql_disablethumbnails',
+    '.ql_disablecache', '.VolumeIcon.icns', 'Icon\r', 'Backups.backupdb', '.com.apple.timemachine.donotpresent',
+    'desktop.ini', 'Desktop.ini', 'Thumbs.db', 'autorun.inf', 'AutoRun.inf',
+    '.directory', '.xdg-volume-info', '.Trash', '.git', '.svn', '.hg',
+])
+
+# Digits in a page folder name's positions, enough for any album under a
+# million photos.  Fixed rather than sized to the album so that pages keep
+# their names as it grows.
+PAGE_NAME_WIDTH = 6
+
+
+def is_client_probe(name):
+    """
+    Whether a file name is one of the metadata files that clients probe for.
+    :param str name: the last component of a path
+    :rtype: bool
+    """
+    return name.startswith('._') or name in CLIENT_PROBE_NAMES or name.startswith('.Trash-')
+
+
+def page_name(start, page_size):
+    """
+    Names the page folder that holds the images at positions start up to
+    start + page_size within a collection, eg, 000001-001000.  Positions count
+    from 1 in the name and are padded to a fixed width, so the names sort in
+    order and an album growing never renames its existing pages.
+    :param int start: position of the page's first image, from 0
+    :param int page_size: images per page
+    :rtype: str
+    """
+    width = max(PAGE_NAME_WIDTH, len(str(start + page_size)))
+    return '{:0{w}d}-{:0{w}d}'.format(start + 1, start + page_size, w=width)
+
+
+def page_start(name, page_size):
+    """
+    Works out where the page a folder name like 001001-002000 starts.
+    :return: position of the page's first image, from 0, or None if name isn't a page of that size
+    :rtype: int
+    """
+    first, sep, last = name.partition('-')
+    if not sep or not first.isdigit() or not last.isdigit():
+        return None
+    start = int(first) - 1
+    if start < 0 or start % page_size or int(last) != start + page_size:
+        return None
+    return start
+
+
+class NegativeCache(object):
+    """
+    A bounded record of paths known not to exist in a particular library
+    generation.  Publishing a new generation empties it.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._paths = OrderedDict()  # Oldest first
+        self._generation = None
+        self._lock = Lock()
+
+    def __contains__(self, key):
+        generation, path = key
+        return self._generation == generation and path in self._paths
+
+    def __len__(self):
+        return len(self._paths)
+
+    def add(self, generation, path):
+        with self._lock:
+            if self._generation != generation:
+                self._paths = OrderedDict()
+                self._generation = generation
+            self._paths[path] = True
+            while len(self._paths) > self.max_entries:
+                self._paths.popitem(last=False)
+
+
 class iPhoto_FUSE_FS(LoggingMixIn, Operations):
     _ck_st_by_path = '_ck_st_by_path'
     _ck_collection_by_name = '_ck_collection_by_name'
     _ck_collection_by_path = '_ck_collection_by_path'
     _ck_folder_listing = '_ck_folder_listing'
     _ck_image_by_path = '_ck_image_by_path'
+    _ck_duplicates = '_ck_duplicates'
+    _ck_page_index = '_ck_page_index'
 
     _CHMOD = 755
 
+    _STATUS_PATH = '/.iphotofs_status'  # Generated file describing library loading progress
+    _VIRTUAL_FH_BASE = 1 << 30  # Handles for generated files start here, well above any real fd
+
+    _DUPLICATES_PATH = '/Duplicates'
+    _DUPLICATES_WAIT = 30  # Seconds a request waits for hashing before giving up with EAGAIN
+
     chmod = os.chmod
     chown = os.chown
     readlink = os.readlink
@@ -40,16 +135,89 @@ class iPhoto_FUSE_FS(LoggingMixIn, Operations):
     opendir = None
     releasedir = None
 
-    def __init__(self, iphoto_lib, verbose=False):
+    def __init__(self, iphoto_lib, verbose=False, negative_cache_size=10000, edited=False, duplicates=False,
+                 sidecars=False, trace=None, control=None, page_size=None):
+        """
+        :param iphoto.iPhotoLibrary iphoto_lib: the library to serve
+        :param int negative_cache_size: how many nonexistent paths to remember
+        :param bool edited: serve each image as last edited rather than the original master
+        :param bool duplicates: add a /Duplicates/<digest>/ folder for each set of identical masters
+        :param bool sidecars: add a <filename>.json metadata file next to each image
+        :param optrace.TraceRecorder trace: records every operation; may be changed while mounted
+        :param str control: path of a UNIX socket to take commands on (see control.py)
+        :param int page_size: split albums and rolls of more than this many images into
+                              folders of this many, eg, 000001-001000, 001001-002000, ...
+        """
         self._library = iphoto_lib
         """:type: iphoto.iPhotoLibrary"""
+        # Listings only depend on file names and album contents, which survive journal updates
+        iphoto_lib.portable_cache_domains.add(self._ck_folder_listing)
+        self._negative = NegativeCache(negative_cache_size)
+        self._versions = None
+        if edited:
+            from versions import VersionIndex
+            self._versions = VersionIndex(iphoto_lib, verbose=verbose)
+        self._content_index = None
+        self._duplicates_job = None  # (generation number, Event, [result]) of the latest hashing run
+        if duplicates:
+            from duplicates import ContentIndex
+            self._content_index = ContentIndex(iphoto_lib, verbose=verbose)
+        self._sidecars = None
+        if sidecars:
+            from sidecars import SidecarCache
+            self._sidecars = SidecarCache()
+        self._page_size = page_size
+        self.trace = trace
+        self._control = None
+        if control:
+            from control import ControlServer
+            self._control = ControlServer(self, control)
         self.rwlock = Lock()
         self.verbose = verbose
+        self._virtual_handles = {}  # fh -> contents of a generated file, snapshotted at open
+        self._status_render = None  # The status file as getattr last sized it, for the next open
+        self._next_virtual_fh = iPhoto_FUSE_FS._VIRTUAL_FH_BASE
+
+    def __call__(self, op, *args):
+        trace = self.trace
+        if trace is not None:
+            return trace.call(self._dispatch, op, args)
+        return self._dispatch(op, *args)
+
+    def _dispatch(self, op, *args):
+        try:
+            return super(iPhoto_FUSE_FS, self).__call__(op, *args)
+        except LibraryNotLoaded:
+            # Still loading in the background and we've waited as long as we're allowed
+            raise FuseOSError(EAGAIN)
+
+    def init(self, path):
+        # Called once FUSE is up (and after any daemonizing), so the thread survives
+        if self._control is not None:
+            self._control.start()
+
+    def destroy(self, path):
+        if self._control is not None:
+            self._control.stop()
 
     @property
     def cache(self):
         return self._library.cache
 
+    def cache_sizes(self):
+        """
+        Returns how much is cached where, for keeping an eye on a running mount.
+        :rtype: OrderedDict
+        """
+        lib = self._library.generation
+        sizes = OrderedDict(('generation {} {}'.format(lib.number, domain), n)
+                            for domain, n in lib.cache.sizes().items())
+        sizes['negative paths'] = len(self._negative)
+        sizes['open generated files'] = len(self._virtual_handles)
+        if self._sidecars is not None:
+            sizes['sidecars'] = str(self._sidecars)
+        return sizes
+
     @property
     def library(self):
         """
@@ -66,171 +234,436 @@ class iPhoto_FUSE_FS(LoggingMixIn, Operations):
         stDict['st_pid'] = pid
         return stDict
 
+    def virtual_file(self, path):
+        """
+        Returns the contents of a generated (not on disk) file.
+        :param str path: path within the filesystem
+        :return: the file contents or None if path is not a generated file
+        :rtype: bytes
+        """
+        if path == self._STATUS_PATH:
+            status = self._library.load_status()
+            return ''.join('{}: {}\n'.format(k, v) for k, v in status.items()).encode('utf-8')
+        if self._sidecars is not None and path.endswith(SIDECAR_EXTENSION):
+            lib = self._library.generation
+            image = self._sidecar_image(lib, path)
+            if image is not None:
+                return self._sidecars.content(lib, image)
+        return None
+
+    def is_virtual_handle(self, fh):
+        return fh in self._virtual_handles
+
+    def _collection(self, lib, c_path):
+        """
+        Returns the album or roll for a path like /Albums/CampingTrip.
+        :param iphoto.iPhotoLibraryGeneration lib: the generation this operation pinned
+        :rtype: iphoto.iPhotoCollection
+        """
+        leadingEls, collName = os.path.split(c_path)  # eg, /Albums and CampingTrip
+        if leadingEls == '/Albums':
+            return lib.album(collName)
+        elif leadingEls == '/Rolls':
+            return lib.roll(collName)
+        return None
+
+    def _is_paged(self, collection):
+        return bool(self._page_size) and collection.num_images > self._page_size
+
+    def _page_names(self, collection):
+        return [page_name(start, self._page_size) for start in range(0, collection.num_images, self._page_size)]
+
+    def _page(self, lib, path):
+        """
+        Returns the collection a page folder like /Albums/Photos/000001-001000 belongs
+        to, and the positions of the images on that page.
+        :param iphoto.iPhotoLibraryGeneration lib: the generation this operation pinned
+        :return: (collection, start, stop), or None if path isn't a page folder
+        :rtype: (iphoto.iPhotoCollection, int, int)
+        """
+        if not self._page_size:
+            return None
+        c_path, name = os.path.split(path)
+        start = page_start(name, self._page_size)
+        if start is None:
+            return None
+        collection = self._collection(lib, c_path)
+        if collection is None or not self._is_paged(collection):
+            return None
+        total = collection.num_images
+        if start >= total or name != page_name(start, self._page_size):
+            return None
+        return collection, start, min(start + self._page_size, total)
+
+    def _page_index(self, lib, path, page):
+        """
+        Returns the images on a page by file name, looking at only that page of the collection.
+        :param str path: the page folder, eg, /Albums/Photos/000001-001000
+        :param page: from _page
+        :rtype: OrderedDict
+        """
+        index = lib.cache.get(self._ck_page_index, path)
+        if index is None:
+            collection, start, stop = page
+            index = OrderedDict()
+            for image in collection.image_range(start, stop):
+                if image is not None and image.filename not in index:  # First one wins, as in a whole collection
+                    index[image.filename] = image
+            lib.cache.set(self._ck_page_index, path, index)
+        return index
+
+    def _duplicate_groups(self, lib):
+        """
+        Returns the sets of identical images in a generation, keyed by content
+        digest, each as a dictionary of unique file name to image.  Hashing
+        runs in the background; callers wait for it a bounded time.
+        :param iphoto.iPhotoLibraryGeneration lib: the generation this operation pinned
+        :rtype: OrderedDict
+        """
+        groups = lib.cache.get(self._ck_duplicates)
+        if groups is not None:
+            return groups
+
+        with self.rwlock:
+            job = self._duplicates_job
+            if job is None or job[0] != lib.number:
+                job = (lib.number, Event(), [])
+
+                def run():
+                    try:
+                        job[2].append(self._content_index.duplicates(lib.images))
+                    finally:
+                        job[1].set()
+
+                self._duplicates_job = job
+                hasher = Thread(target=run, name='iphotofs-hash')
+                hasher.daemon = True
+                hasher.start()
+        if not job[1].wait(self._DUPLICATES_WAIT):
+            raise FuseOSError(EAGAIN)
+        if not job[2]:
+            raise FuseOSError(EIO)
+
+        groups = OrderedDict()
+        for digest, images in job[2][0].items():
+            names = OrderedDict()
+            for image in images:
+                name = image.filename
+                if name in names:  # Same name in different rolls; tell them apart by GUID
+                    base, ext = os.path.splitext(name)
+                    name = '{} ({}){}'.format(base, image.guid, ext)
+                names[name] = image
+            groups[digest] = names
+        return lib.cache.set(self._ck_duplicates, groups)
+
+    def _image(self, lib, path):
+        """
+        Returns the image for a path like /Albums/CampingTrip/IMG_1234.JPG.
+        :param iphoto.iPhotoLibraryGeneration lib: the generation this operation pinned
+        :rtype: iphoto.iPhotoImage
+        """
+        cache = lib.cache
+        image = cache.get(self._ck_image_by_path, path)
+        if image is None and self._content_index is not None and path.startswith(self._DUPLICATES_PATH + '/'):
+            digest, _, imgName = path[len(self._DUPLICATES_PATH) + 1:].partition('/')
+            return self._duplicate_groups(lib).get(digest, {}).get(imgName)
+        if image is None:
+            leadingEls, imgName = os.path.split(path)
+            page = self._page(lib, leadingEls)
+            if page is not None:
+                image = self._page_index(lib, leadingEls, page).get(imgName)
+                if image is not None:
+                    cache.set(self._ck_image_by_path, path, image)
+                return image
+            collection = self._collection(lib, leadingEls)
+            if collection is not None and not self._is_paged(collection):
+                image = collection.image_by_filename(imgName)
+                if image is not None:
+                    cache.set(self._ck_image_by_path, path, image)
+        return image
+
+    def _sidecar_image(self, lib, path):
+        """
+        Returns the image a path like /Albums/CampingTrip/IMG_1234.JPG.json describes.
+        :param iphoto.iPhotoLibraryGeneration lib: the generation this operation pinned
+        :rtype: iphoto.iPhotoImage
+        """
+        if self._sidecars is None or not path.endswith(SIDECAR_EXTENSION):
+            return None
+        if not (path.startswith('/Albums/') or path.startswith('/Rolls/')):
+            return None
+        return self._image(lib, path[:-len(SIDECAR_EXTENSION)])
+
+    def _image_file(self, image):
+        """
+        Returns the file on disk that is served for an image.
+        :param iphoto.iPhotoImage image: the image
+        :rtype: str
+        """
+        if self._versions is not None:
+            return self._versions.edited_path(image)
+        return image.abspath
+
     def open(self, path, flags=0, mode=0):
         if self.verbose:
             print("open: {} (flags={}, mode={}".format(path, flags, mode))
 
-        self.getattr(path)  # Loads info about image to cache
-        image = self.cache.get(self._ck_image_by_path, path)
+        if path == self._STATUS_PATH:
+            # Serve what getattr last measured, which is the size the kernel will read up to
+            content = self._status_render or self.virtual_file(path)
+        else:
+            content = self.virtual_file(path)
+        if content is not None:
+            with self.rwlock:
+                fh = self._next_virtual_fh
+                self._next_virtual_fh += 1
+                self._virtual_handles[fh] = content
+            return fh
+
+        image = self._image(self._library.generation, path)
         """:type: iphoto.iPhotoImage"""
         if image is not None:
-            return os.open(image.abspath, flags, mode)
-        else:
-            return None
+            return os.open(self._image_file(image), flags, mode)
+        raise FuseOSError(ENOENT)
 
     def read(self, path, size, offset, fh):
-        # If we've already enumerated the enclosing folder, then
-        # we have all the data we need to read it.
-        # If someone tries to read a file without having first
-        # enumerated the folder (such as a file with a fixed,
-        # known location), then we need to get some info first.
+        # The handle is a real file descriptor opened in open(), so no
+        # library lookup is needed (and the generation may have moved on).
 
         if self.verbose:
             print("read: {} (size={}, offset={}".format(path, size, offset))
 
-        image = self.cache.get(self._ck_image_by_path, path)
-        """:type: iphoto.iPhotoImage"""
-        #        if self._ck_image_by_path in self._cache and path in self._cache[self._ck_image_by_path]:
-        if image is not None:
-            with self.rwlock:
-                os.lseek(fh, offset, 0)
-                return os.read(fh, size)
-        raise RuntimeError('unexpected path: %r' % path)
+        content = self._virtual_handles.get(fh)
+        if content is not None:
+            return content[offset:offset + size]
+
+        with self.rwlock:
+            os.lseek(fh, offset, 0)
+            return os.read(fh, size)
 
     def getattr(self, path, fh=None):
         if self.verbose:
             print("getattr: {}".format(path))
 
-        cache = self.cache
+        if path == self._STATUS_PATH:  # Changes constantly, so never cached
+            content = self._virtual_handles.get(fh) if fh is not None else None
+            if content is None:  # Not fstat() on an open handle, whose snapshot must keep its size
+                content = self._status_render = self.virtual_file(path)
+            now = time.mktime(datetime.datetime.now().timetuple())
+            return self.add_uid_gid_pid(dict(
+                st_mode=(S_IFREG | 0o444), st_nlink=1, st_size=len(content),
+                st_ctime=now, st_atime=now, st_mtime=now))
+
+        if path == '/':
+            nlink = 5 if self._content_index is not None else 4  # . .. Albums Rolls [Duplicates]
+            return dict(st_mode=(S_IFDIR | iPhoto_FUSE_FS._CHMOD), st_nlink=nlink)
+
+        if (path == '/Albums' or path == '/Rolls') and not self._library.is_loaded:
+            # Answer right away while the library loads, but don't cache the guess
+            now = time.mktime(datetime.datetime.now().timetuple())
+            return self.add_uid_gid_pid(dict(
+                st_mode=(S_IFDIR | iPhoto_FUSE_FS._CHMOD), st_nlink=2,
+                st_ctime=now, st_atime=now, st_mtime=now))
+
+        if is_client_probe(os.path.basename(path)):
+            raise FuseOSError(ENOENT)
+
+        # Everything below uses this one generation, even if a reload publishes a new one meanwhile
+        lib = self._library.generation
+        """:type: iphoto.iPhotoLibraryGeneration"""
+        cache = lib.cache
         """:type: iphoto.Cache"""
 
+        if (lib.number, path) in self._negative:
+            raise FuseOSError(ENOENT)
+
         st = cache.get(self._ck_st_by_path, path)
         if st is not None:
             return st
         else:
 
-            if path == '/':  # If cache is cleared, '/' stat needs to be specified
-                st = dict(st_mode=(S_IFDIR | iPhoto_FUSE_FS._CHMOD), st_nlink=4)  # 4 = . .. Albums Rolls
-                return cache.set(self._ck_st_by_path, path, st)
-
-            elif path == '/Albums' or path == '/Rolls':
-                nlink = 2 + self._library.num_collections(path[1:])  # And remove leading slash
+            if path == '/Albums' or path == '/Rolls':
+                nlink = 2 + lib.num_collections(path[1:])  # And remove leading slash
                 now = time.mktime(datetime.datetime.now().timetuple())
                 st = self.add_uid_gid_pid(dict(
                     st_mode=(S_IFDIR | iPhoto_FUSE_FS._CHMOD), st_nlink=nlink,
                     st_ctime=now, st_atime=now, st_mtime=now))
                 return cache.set(self._ck_st_by_path, path, st)
 
+            elif self._content_index is not None and path == self._DUPLICATES_PATH:
+                now = time.mktime(datetime.datetime.now().timetuple())
+                return self.add_uid_gid_pid(dict(
+                    st_mode=(S_IFDIR | iPhoto_FUSE_FS._CHMOD), st_nlink=2,
+                    st_ctime=now, st_atime=now, st_mtime=now))
+
+            elif self._content_index is not None and path.startswith(self._DUPLICATES_PATH + '/'):
+                leadingEls, tail = os.path.split(path)
+                if leadingEls == self._DUPLICATES_PATH:  # A set of identical images
+                    group = self._duplicate_groups(lib).get(tail)
+                    if group is not None:
+                        now = time.mktime(datetime.datetime.now().timetuple())
+                        st = self.add_uid_gid_pid(dict(
+                            st_mode=(S_IFDIR | iPhoto_FUSE_FS._CHMOD), st_nlink=2,
+                            st_ctime=now, st_atime=now, st_mtime=now))
+                        return cache.set(self._ck_st_by_path, path, st)
+                else:
+                    image = self._image(lib, path)
+                    if image is not None:
+                        st = os.lstat(self._image_file(image))
+                        st = self.add_uid_gid_pid(
+                            dict((key, getattr(st, key)) for key in
+                                 ('st_atime', 'st_ctime', 'st_mode', 'st_mtime', 'st_nlink', 'st_size')))
+                        return cache.set(self._ck_st_by_path, path, st)
+
             elif path.startswith('/Albums/') or path.startswith('/Rolls/'):
                 leadingEls, tail = os.path.split(path)  # eg, /Albums and CampingTrip
+                page = self._page(lib, path)
 
                 # Asking about an album or roll
                 if leadingEls == '/Albums' or leadingEls == '/Rolls':  # Asking us about specific album or roll
-                    collName = tail
-                    if leadingEls == '/Albums':
-                        collection = self._library.album(collName)
-                    elif leadingEls == '/Rolls':
-                        collection = self._library.roll(collName)
-                    else:
-                        collection = None
+                    collection = self._collection(lib, path)
                     if collection is not None:
-                        nlink = 2 + collection.num_images
+                        if self._is_paged(collection):
+                            nlink = 2 + len(self._page_names(collection))
+                        else:
+                            nlink = 2 + collection.num_images
                         now = time.mktime(datetime.datetime.now().timetuple())
                         st = self.add_uid_gid_pid(dict(
                             st_mode=(S_IFDIR | iPhoto_FUSE_FS._CHMOD), st_nlink=nlink,
                             st_ctime=now, st_atime=now, st_mtime=now))
                         return cache.set(self._ck_st_by_path, path, st)
 
+                # Asking about a page of a large album or roll
+                elif page is not None:
+                    _, start, stop = page
+                    now = time.mktime(datetime.datetime.now().timetuple())
+                    st = self.add_uid_gid_pid(dict(
+                        st_mode=(S_IFDIR | iPhoto_FUSE_FS._CHMOD), st_nlink=2 + stop - start,
+                        st_ctime=now, st_atime=now, st_mtime=now))
+                    return cache.set(self._ck_st_by_path, path, st)
+
                 # Asking about an image
                 else:
-                    imgName = tail
-                    collType, collName = os.path.split(leadingEls)
-                    image = None
+                    image = self._image(lib, path)
                     """:type: iphoto.iPhotoImage"""
 
-                    if collType == '/Albums':
-                        image = self._library.album(collName).image_by_filename(imgName)
-                        """:type: iphoto.iPhotoImage"""
-
-                    elif collType == '/Rolls':
-                        image = self._library.roll(collName).image_by_filename(imgName)
-                        """:type: iphoto.iPhotoImage"""
-
                     if image is not None:
-                        st = os.lstat(image.abspath)
+                        st = os.lstat(self._image_file(image))
                         st = self.add_uid_gid_pid(
                             dict((key, getattr(st, key)) for key in
                                  ('st_atime', 'st_ctime', 'st_mode', 'st_mtime', 'st_nlink', 'st_size')))
-                        cache.set(self._ck_image_by_path, path, image)
                         return cache.set(self._ck_st_by_path, path, st)
 
-        # In theory, we should never be here except by some error
+                    # Or its metadata sidecar, which changes only when AlbumData.xml does
+                    image = self._sidecar_image(lib, path)
+                    if image is not None:
+                        st = self.add_uid_gid_pid(dict(
+                            st_mode=(S_IFREG | 0o444), st_nlink=1, st_size=self._sidecars.size(lib, image),
+                            st_ctime=lib.mtime, st_atime=lib.mtime, st_mtime=lib.mtime))
+                        return cache.set(self._ck_st_by_path, path, st)
+
+        # Doesn't exist; remember that so asking again is cheap
+        self._negative.add(lib.number, path)
         raise FuseOSError(ENOENT)
 
     def readdir(self, path, fh=None):
         default = ['.', '..']
-        cache = self.cache
 
         if self.verbose:
             print("readdir: {}".format(path))
 
+        if path == '/':
+            if self._content_index is not None:
+                return default + ['Albums', 'Rolls', self._DUPLICATES_PATH[1:], self._STATUS_PATH[1:]]
+            return default + ['Albums', 'Rolls', self._STATUS_PATH[1:]]
+
+        lib = self._library.generation
+        """:type: iphoto.iPhotoLibraryGeneration"""
+        cache = lib.cache
+
         # Quick cache return
         listing = cache.get(self._ck_folder_listing, path)
         if listing is not None:
             return listing
 
         else:
-            if path == '/':
-                return cache.set(self._ck_folder_listing, path, default + ['Albums', 'Rolls'])
-
-            elif path == '/Albums':
-                return cache.set(self._ck_folder_listing, path, default + self._library.album_names)
+            if path == '/Albums':
+                return cache.set(self._ck_folder_listing, path, default + lib.album_names)
 
             elif path == '/Rolls':
-                return cache.set(self._ck_folder_listing, path, default + self._library.roll_names)
+                return cache.set(self._ck_folder_listing, path, default + lib.roll_names)
 
 
             # Ought to be listing albums or rolls, nothing else
             # (except meta data that the OS might be querying
-            elif path.startswith('/Albums/') or path.startswith('/Rolls/'):
-                leadingEls, collName = os.path.split(path)  # eg, /Albums and CampingTrip
+            elif self._content_index is not None and path == self._DUPLICATES_PATH:
+                return default + list(self._duplicate_groups(lib).keys())
 
-                # Based on result of split we can assume something about leadingEls
-                if leadingEls == '/Albums':
-                    collection = self._library.album(collName)
-                elif leadingEls == '/Rolls':
-                    collection = self._library.roll(collName)
-                else:
-                    collection = None
+            elif self._content_index is not None and path.startswith(self._DUPLICATES_PATH + '/'):
+                group = self._duplicate_groups(lib).get(os.path.basename(path))
+                if group is not None:
+                    return default + list(group.keys())
 
+            elif path.startswith('/Albums/') or path.startswith('/Rolls/'):
+                page = self._page(lib, path)
+                if page is not None:
+                    names = list(self._page_index(lib, path, page).keys())
+                    if self._sidecars is not None:
+                        names += [n + SIDECAR_EXTENSION for n in names]
+                    return cache.set(self._ck_folder_listing, path, default + names)
+                collection = self._collection(lib, path)
+                if collection is not None and self._is_paged(collection):
+                    return cache.set(self._ck_folder_listing, path, default + self._page_names(collection))
                 if collection is not None:
-                    return cache.set(self._ck_folder_listing, path, default + \
-                                     [i.filename for i in collection.images])
+                    names = [i.filename for i in collection.images if i is not None]
+                    if self._sidecars is not None:
+                        names += [n + SIDECAR_EXTENSION for n in names]
+                    return cache.set(self._ck_folder_listing, path, default + names)
 
         return []
 
     def flush(self, path, fh):
         if self.verbose:
             print("flush: {}".format(path))
+        if self.is_virtual_handle(fh):
+            return 0
         return os.fsync(fh)
 
     def fsync(self, path, datasync, fh):
         if self.verbose:
             print("fsync: {} (datasync={})".format(path, datasync))
+        if self.is_virtual_handle(fh):
+            return 0
         return os.fsync(fh)
 
     def release(self, path, fh):
         if self.verbose:
             print("release: {}".format(path))
+        if self._virtual_handles.pop(fh, None) is not None:
+            return 0
         return os.close(fh)
 
 
-def mount_iphotofs(library, mount=None, foreground=True, verbose=False):
+class _ContextFreeFS(iPhoto_FUSE_FS):
+    """
+    The fusepy operations, minus the call to fuse_get_context(), which only
+    works on a thread that fusepy itself is driving.
     """
 
-    :param iphoto.iPhotoLibrary library:
-    :param str mount:
-    :return: None
+    def add_uid_gid_pid(self, stDict):
+        stDict['st_uid'] = os.getuid()
+        stDict['st_gid'] = os.getgid()
+        stDict['st_pid'] = os.getpid()
+        return stDict
+
+
+def prepare_mount_point(name, mount=None):
+    """
+    Works out (and creates if necessary) the folder to mount on.
+    :param str name: the name to give an automatically-created mount point
+    :param str mount: the requested mount point, '-', '-<folder>' or None
+    :return: the mount point
+    :rtype: str
     """
 
     def remove_mount(mount):
@@ -262,7 +695,7 @@ def mount_iphotofs(library, mount=None, foreground=True, verbose=False):
     # Use the default location like /Volumes
     # and make the mount folder to be the library name
     if mount is None or mount == '-':
-        mount = os.path.join(preferredMountLocation, library.name)
+        mount = os.path.join(preferredMountLocation, name)
         try:
             os.makedirs(mount)
         except OSError:
@@ -277,7 +710,7 @@ def mount_iphotofs(library, mount=None, foreground=True, verbose=False):
     # Make the mount location the library name but
     # put it in the location designated
     elif mount.startswith('-'):
-        mount = os.path.join(mount[1:], library.name)
+        mount = os.path.join(mount[1:], name)
         try:
             os.makedirs(mount)
         except OSError:
@@ -288,19 +721,47 @@ def mount_iphotofs(library, mount=None, foreground=True, verbose=False):
         # so we want to register the absolute path
         atexit.register(remove_mount, os.path.abspath(mount))
 
+    return mount
+
+
+def mount_iphotofs(library, mount=None, foreground=True, verbose=False, engine='threads', negative_timeout=30,
+                   **fs_options):
+    """
+
+    :param iphoto.iPhotoLibrary library:
+    :param str mount:
+    :param fs_options: passed on to iPhoto_FUSE_FS, eg, edited=True
+    :param float negative_timeout: seconds the kernel may remember that a name doesn't exist
+    :param str engine: 'threads' for fusepy's thread-per-request loop or
+                       'trio' for the pyfuse3/trio engine in iphotofuse_async
+    :return: None
+    """
+    if engine == 'trio':
+        for option in ('trace', 'control'):
+            if fs_options.get(option) is not None:
+                raise ValueError("{} works with the threads engine only".format(option))
+    mount = prepare_mount_point(library.name, mount)
+
     # try:
     if verbose:
         print("Library", str(library))
         print("Mounting to", mount)
+    if engine == 'trio':
+        from iphotofuse_async import mount_iphotofs_async
+        return mount_iphotofs_async(library, mount, verbose=verbose, negative_timeout=negative_timeout,
+                                    **fs_options)
+    elif engine != 'threads':
+        raise ValueError("Unknown mount engine: {}".format(engine))
     fuse = FUSE(
-        iPhoto_FUSE_FS(library),
+        iPhoto_FUSE_FS(library, verbose=verbose, **fs_options),
         mount,
         nothreads=False,
         foreground=foreground,
         ro=True,
         allow_other=True,
         fsname=library.name,
-        volname=library.name
+        volname=library.name,
+        negative_timeout=negative_timeout
     )
     return fuse
     # except Exception:
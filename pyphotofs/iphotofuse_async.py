@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# Requires Python 3, pyfuse3 and trio
+"""
+An asynchronous mount engine for iPhoto libraries built on pyfuse3 and trio.
+
+The threaded fusepy engine in iphotofuse dedicates a thread to each outstanding
+request.  This engine instead services every request as a trio task in a
+single process: the existing iPhoto_FUSE_FS logic is reused for metadata,
+but it runs on worker threads (bounded by a CapacityLimiter) and file data is
+read with os.pread() so no lock is held around seek+read.
+"""
+import errno
+import os
+import stat
+import sys
+import traceback
+
+import pyfuse3
+import trio
+
+from iphoto import LibraryNotLoaded
+from iphotofuse import FuseOSError, _ContextFreeFS
+
+__author__ = "Robert Harder"
+__email__ = "rob@iharder.net"
+__copyright__ = "This code is released into the Public Domain"
+__version__ = "0.1"
+__status__ = "Development"
+
+
+class iPhoto_Async_FS(pyfuse3.Operations):
+    """
+    Serves the same Albums/Rolls hierarchy as iPhoto_FUSE_FS, but as coroutines.
+    pyfuse3 speaks in inodes rather than paths, so an inode <-> path table is
+    kept here.  All table updates happen on the trio thread and need no lock.
+    """
+
+    enable_writeback_cache = False
+
+    # How long the kernel may trust an entry or its attributes, as with fusepy,
+    # so that a reloaded library shows up promptly
+    _ENTRY_TIMEOUT = 1.0
+    _ATTR_TIMEOUT = 1.0
+    _READDIR_BATCH = 64  # Entries stat'ed per trip to the worker threads while listing
+
+    def __init__(self, iphoto_lib, max_threads=64, verbose=False, negative_timeout=30, **fs_options):
+        super(iPhoto_Async_FS, self).__init__()
+        self._negative_timeout = negative_timeout
+        self._fs = _ContextFreeFS(iphoto_lib, verbose=verbose, **fs_options)
+        self._limiter = trio.CapacityLimiter(max_threads)
+        self._path_by_inode = {pyfuse3.ROOT_INODE: '/'}
+        self._inode_by_path = {'/': pyfuse3.ROOT_INODE}
+        self._next_inode = pyfuse3.ROOT_INODE + 1
+        self._dir_listings = {}  # Directory handle -> [names]
+        self._next_dir_handle = 1
+        self.verbose = verbose
+
+    @property
+    def library(self):
+        """
+        Returns the corresponding iPhotoLibrary
+        :return: the iPhoto library
+        :rtype: iPhotoLibrary
+        """
+        return self._fs.library
+
+    @property
+    def operations(self):
+        """
+        Returns the synchronous iPhoto_FUSE_FS this engine delegates to
+        :rtype: iPhoto_FUSE_FS
+        """
+        return self._fs
+
+    def _inode(self, path):
+        inode = self._inode_by_path.get(path)
+        if inode is None:
+            inode = self._next_inode
+            self._next_inode += 1
+            self._inode_by_path[path] = inode
+            self._path_by_inode[inode] = path
+        return inode
+
+    def _path(self, inode):
+        path = self._path_by_inode.get(inode)
+        if path is None:
+            raise pyfuse3.FUSEError(errno.ENOENT)
+        return path
+
+    async def _run(self, func, *args):
+        """
+        Runs a blocking call on a worker thread, translating fusepy errors.
+        Anything else is a bug; it is reported and the request fails with EIO
+        rather than taking the whole mount down.
+        """
+        try:
+            return await trio.to_thread.run_sync(func, *args, limiter=self._limiter)
+        except FuseOSError as e:
+            raise pyfuse3.FUSEError(e.errno)
+        except LibraryNotLoaded:
+            raise pyfuse3.FUSEError(errno.EAGAIN)
+        except OSError as e:
+            raise pyfuse3.FUSEError(e.errno or errno.EIO)
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            raise pyfuse3.FUSEError(errno.EIO)
+
+    def _entry(self, path, st):
+        """
+        Converts a fusepy-style stat dictionary to pyfuse3 EntryAttributes.
+        """
+        entry = pyfuse3.EntryAttributes()
+        entry.st_ino = self._inode(path)
+        entry.st_mode = st.get('st_mode', stat.S_IFDIR | 0o755)
+        entry.st_nlink = st.get('st_nlink', 1)
+        entry.st_size = st.get('st_size', 0)
+        entry.st_uid = st.get('st_uid', os.getuid())
+        entry.st_gid = st.get('st_gid', os.getgid())
+        entry.st_atime_ns = int(st.get('st_atime', 0) * 1e9)
+        entry.st_mtime_ns = int(st.get('st_mtime', 0) * 1e9)
+        entry.st_ctime_ns = int(st.get('st_ctime', 0) * 1e9)
+        entry.entry_timeout = self._ENTRY_TIMEOUT
+        entry.attr_timeout = self._ATTR_TIMEOUT
+        return entry
+
+    async def lookup(self, parent_inode, name, ctx=None):
+        name = os.fsdecode(name)
+        parent = self._path(parent_inode)
+        if name == '.':
+            path = parent
+        elif name == '..':
+            path = os.path.dirname(parent)
+        else:
+            path = os.path.join(parent, name)
+        if self.verbose:
+            print("lookup: {}".format(path))
+        try:
+            st = await self._run(self._fs.getattr, path)
+        except pyfuse3.FUSEError as e:
+            if e.errno != errno.ENOENT or not self._negative_timeout:
+                raise
+            # An inode of zero tells the kernel to cache the miss itself
+            entry = pyfuse3.EntryAttributes()
+            entry.st_ino = 0
+            entry.entry_timeout = self._negative_timeout
+            return entry
+        return self._entry(path, st)
+
+    async def getattr(self, inode, ctx=None):
+        path = self._path(inode)
+        if self.verbose:
+            print("getattr: {}".format(path))
+        st = await self._run(self._fs.getattr, path)
+        return self._entry(path, st)
+
+    async def opendir(self, inode, ctx=None):
+        path = self._path(inode)
+        names = await self._run(self._fs.readdir, path)
+        names = [n for n in names if n not in ('.', '..')]
+        fh = self._next_dir_handle
+        self._next_dir_handle += 1
+        self._dir_listings[fh] = (path, names)
+        return fh
+
+    async def readdir(self, fh, start_id, token):
+        path, names = self._dir_listings[fh]
+        if self.verbose:
+            print("readdir: {} (start_id={})".format(path, start_id))
+
+        def _stat_all(children):
+            return [(child, self._fs.getattr(os.path.join(path, child))) for child in children]
+
+        # The kernel asks for a buffer's worth at a time, so stat a batch per trip
+        # to the thread pool and stop as soon as the reply is full
+        for batch_start in range(start_id, len(names), self._READDIR_BATCH):
+            batch = names[batch_start:batch_start + self._READDIR_BATCH]
+            for i, (child, st) in enumerate(await self._run(_stat_all, batch), batch_start):
+                entry = self._entry(os.path.join(path, child), st)
+                if not pyfuse3.readdir_reply(token, os.fsencode(child), entry, i + 1):
+                    return
+
+    async def releasedir(self, fh):
+        self._dir_listings.pop(fh, None)
+
+    async def open(self, inode, flags, ctx=None):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            raise pyfuse3.FUSEError(errno.EROFS)
+        path = self._path(inode)
+        if self.verbose:
+            print("open: {} (flags={})".format(path, flags))
+        fh = await self._run(self._fs.open, path, os.O_RDONLY)
+        if fh is None:
+            raise pyfuse3.FUSEError(errno.ENOENT)
+        if self._fs.is_virtual_handle(fh):  # Generated contents change between opens
+            return pyfuse3.FileInfo(fh=fh, direct_io=True)
+        return pyfuse3.FileInfo(fh=fh, keep_cache=True)
+
+    async def read(self, fh, off, size):
+        if self._fs.is_virtual_handle(fh):
+            return self._fs.read(None, size, off, fh)
+        # pread() has no shared file offset, so no lock is needed
+        return await self._run(os.pread, fh, size, off)
+
+    async def release(self, fh):
+        if self._fs.is_virtual_handle(fh):
+            self._fs.release(None, fh)
+        else:
+            await self._run(os.close, fh)
+
+    async def forget(self, inode_list):
+        for inode, _ in inode_list:
+            if inode == pyfuse3.ROOT_INODE:
+                continue
+            path = self._path_by_inode.pop(inode, None)
+            if path is not None:
+                self._inode_by_path.pop(path, None)
+
+
+def mount_iphotofs_async(library, mount, max_threads=64, max_tasks=1000, verbose=False, negative_timeout=30,
+                         **fs_options):
+    """
+    Mounts the library with the pyfuse3/trio engine and blocks until unmounted.
+    :param iphoto.iPhotoLibrary library: the library to serve
+    :param str mount: the mount point, which must already exist
+    :param int max_threads: how many blocking calls may be on worker threads at once
+    :param int max_tasks: how many outstanding FUSE requests pyfuse3 may service at once
+    :param float negative_timeout: seconds the kernel may remember that a name doesn't exist
+    :param fs_options: passed on to iPhoto_FUSE_FS, eg, edited=True
+    :return: None
+    """
+    fs = iPhoto_Async_FS(library, max_threads=max_threads, verbose=verbose, negative_timeout=negative_timeout,
+                         **fs_options)
+    options = set(pyfuse3.default_options)
+    options.add('ro')
+    options.add('allow_other')
+    options.add('fsname=' + library.name)
+    options.discard('default_permissions')
+    pyfuse3.init(fs, mount, options)
+    try:
+        trio.run(pyfuse3.main, 1, max_tasks)
+    finally:
+        pyfuse3.close()
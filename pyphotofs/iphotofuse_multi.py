@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# Should work with Python 2 or 3
+"""
+Serves many iPhoto libraries from a single mount as /<LibraryName>/Albums|Rolls/...
+
+Each library is only parsed the first time something underneath it is
+accessed and is dropped again after it has been idle for a while.  All of the
+libraries (and their caches) draw from one shared CacheBudget, so a burst of
+activity in one library pushes the least recently used ones out of memory.
+"""
+import threading
+
+from iphotofuse import *
+
+__author__ = "Robert Harder"
+__email__ = "rob@iharder.net"
+__copyright__ = "This code is released into the Public Domain"
+__version__ = "0.1"
+__status__ = "Development"
+
+
+class iPhoto_Multi_FUSE_FS(LoggingMixIn, Operations):
+    _CHMOD = 755
+
+    # Disable unused operations:
+    getxattr = None
+    listxattr = None
+    opendir = None
+    releasedir = None
+
+    def __init__(self, library_paths, idle_seconds=600, budget=None, verbose=False, **fs_options):
+        """
+        :param [str] library_paths: the libraries to serve
+        :param int idle_seconds: unload a library after this long without access
+        :param iphoto.CacheBudget budget: memory budget shared by all the libraries
+        :param fs_options: passed on to each library's iPhoto_FUSE_FS, eg, edited=True
+        """
+        self._paths = OrderedDict((library_name(p), p) for p in library_paths)
+        self._loaded = {}  # name -> iPhoto_FUSE_FS
+        self._virtual_owners = {}  # (name, fh) -> iPhoto_FUSE_FS of an open generated file, until released
+        self._last_access = {}  # name -> time.time() of last access
+        self._load_locks = dict((name, Lock()) for name in self._paths)
+        self._budget = budget if budget is not None else CacheBudget(verbose=verbose)
+        self._idle_seconds = idle_seconds
+        self._fs_options = fs_options
+        self._reaper = None
+        self._stopped = threading.Event()
+        self.rwlock = Lock()
+        self.verbose = verbose
+
+    @property
+    def budget(self):
+        return self._budget
+
+    @property
+    def library_names(self):
+        return list(self._paths.keys())
+
+    def loaded_library_names(self):
+        return list(self._loaded.keys())
+
+    def _fs(self, name):
+        """
+        Returns the iPhoto_FUSE_FS for a library, loading it if necessary.
+        :rtype: iPhoto_FUSE_FS
+        """
+        if name not in self._paths:
+            raise FuseOSError(ENOENT)
+        self._last_access[name] = time.time()
+        fs = self._loaded.get(name)
+        if fs is None:
+            with self._load_locks[name]:  # Only one thread parses a given library
+                fs = self._loaded.get(name)
+                if fs is None:
+                    if self.verbose:
+                        print("loading library", self._paths[name])
+                    library = iPhotoLibrary(self._paths[name], budget=self._budget)
+                    fs = iPhoto_FUSE_FS(library, verbose=self.verbose, **self._fs_options)
+                    self._loaded[name] = fs
+                    # The parsed plist is charged at roughly one entry per image
+                    self._budget.charge(library, library.num_images, lambda: self.unload(name))
+        self._budget.touch(fs.library)
+        return fs
+
+    def unload(self, name):
+        """
+        Drops a loaded library.  Operations already in flight keep their own
+        reference to it and finish normally.
+        :param str name: the library name
+        """
+        fs = self._loaded.pop(name, None)
+        if fs is not None:
+            if self.verbose:
+                print("unloading library", name)
+            self._budget.release(fs.library)
+            # Straight to the current generation: fs.cache would check for changes and could start a reload
+            generation = fs.library._generation
+            if generation is not None:
+                self._budget.release(generation.cache)
+
+    def unload_idle(self):
+        """
+        Unloads every library that has not been accessed for idle_seconds.
+        """
+        cutoff = time.time() - self._idle_seconds
+        for name in list(self._loaded.keys()):
+            if self._last_access.get(name, 0) < cutoff:
+                self.unload(name)
+
+    def _reap(self):
+        while not self._stopped.wait(min(self._idle_seconds, 60)):
+            self.unload_idle()
+
+    def init(self, path):
+        # Called once FUSE is up (and after any daemonizing), so the thread survives
+        self._reaper = threading.Thread(target=self._reap, name='iphotofs-reaper')
+        self._reaper.daemon = True
+        self._reaper.start()
+
+    def destroy(self, path):
+        self._stopped.set()
+
+    def _split(self, path):
+        """
+        Splits /<LibraryName>/rest into the library name and /rest.
+        """
+        parts = path.lstrip('/').split('/', 1)
+        return parts[0], '/' + (parts[1] if len(parts) > 1 else '')
+
+    def getattr(self, path, fh=None):
+        if self.verbose:
+            print("getattr: {}".format(path))
+        if path == '/':
+            nlink = 2 + len(self._paths)
+            return dict(st_mode=(S_IFDIR | iPhoto_Multi_FUSE_FS._CHMOD), st_nlink=nlink)
+        name, sub_path = self._split(path)
+        return self._fs(name).getattr(sub_path, fh)
+
+    def readdir(self, path, fh=None):
+        if self.verbose:
+            print("readdir: {}".format(path))
+        if path == '/':
+            return ['.', '..'] + self.library_names
+        name, sub_path = self._split(path)
+        return self._fs(name).readdir(sub_path, fh)
+
+    def open(self, path, flags=0, mode=0):
+        name, sub_path = self._split(path)
+        fs = self._fs(name)
+        fh = fs.open(sub_path, flags, mode)
+        if fs.is_virtual_handle(fh):  # Its contents live in fs, which must outlast an unload
+            self._virtual_owners[(name, fh)] = fs
+        return fh
+
+    def _virtual_owner(self, path, fh):
+        """
+        Returns the iPhoto_FUSE_FS that opened fh if it is a generated-file handle,
+        even if that library has been unloaded since.
+        """
+        return self._virtual_owners.get((self._split(path)[0], fh))
+
+    def read(self, path, size, offset, fh):
+        fs = self._virtual_owner(path, fh)
+        if fs is not None:
+            return fs.read(self._split(path)[1], size, offset, fh)
+        # The handle is a real file descriptor, so there is no need to go
+        # through the library (which may even have been unloaded since open)
+        with self.rwlock:
+            os.lseek(fh, offset, 0)
+            return os.read(fh, size)
+
+    def flush(self, path, fh):
+        if self._virtual_owner(path, fh) is not None:
+            return 0
+        return os.fsync(fh)
+
+    def fsync(self, path, datasync, fh):
+        if self._virtual_owner(path, fh) is not None:
+            return 0
+        return os.fsync(fh)
+
+    def release(self, path, fh):
+        fs = self._virtual_owners.pop((self._split(path)[0], fh), None)
+        if fs is not None:
+            return fs.release(self._split(path)[1], fh)
+        return os.close(fh)
+
+
+def mount_iphotofs_multi(library_paths, mount=None, name='iPhoto Libraries', foreground=True,
+                         idle_seconds=600, max_entries=250000, verbose=False, engine='threads', negative_timeout=30,
+                         **fs_options):
+    """
+    Mounts several libraries under one mount point.
+    :param [str] library_paths: the libraries to serve
+    :param str mount: the mount point, as for mount_iphotofs
+    :param str name: the volume name, also used for an automatic mount point
+    :param int idle_seconds: unload a library after this long without access
+    :param int max_entries: shared CacheBudget size across all libraries
+    :param str engine: only 'threads' can serve several libraries
+    :param float negative_timeout: seconds the kernel may remember that a name doesn't exist
+    :param fs_options: passed on to each library's iPhoto_FUSE_FS, eg, edited=True;
+                       trace and control work with a single library only
+    :return: None
+    """
+    if engine != 'threads':
+        raise ValueError("Only the threads engine can serve several libraries, not {}".format(engine))
+    for option in ('trace', 'control'):
+        if fs_options.pop(option, None) is not None:
+            raise ValueError("{} works with a single library only".format(option))
+    mount = prepare_mount_point(name, mount)
+    if verbose:
+        print("Libraries", ', '.join(library_paths))
+        print("Mounting to", mount)
+    fs = iPhoto_Multi_FUSE_FS(library_paths, idle_seconds=idle_seconds,
+                              budget=CacheBudget(max_entries, verbose=verbose), verbose=verbose, **fs_options)
+    return FUSE(
+        fs,
+        mount,
+        nothreads=False,
+        foreground=foreground,
+        ro=True,
+        allow_other=True,
+        fsname=name,
+        volname=name,
+        negative_timeout=negative_timeout
+    )
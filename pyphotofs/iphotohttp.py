@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# Should work with Python 2 or 3 (sendfile needs Python 3.5+)
+"""
+Serves an iPhoto library read-only over HTTP, for hosts and containers
+where a FUSE mount isn't possible.
+
+The layout is the same as the mounted filesystem: /Albums/<name>/<file>
+and /Rolls/<name>/<file>.  Folders are listed as JSON.  Files are sent
+with sendfile() so the data never passes through Python, carry an ETag
+and Last-Modified so clients can revalidate cheaply, and honor single
+byte ranges (Range, If-Range) so that large files can be fetched in
+pieces.  Connections are kept alive between requests.
+"""
+from __future__ import print_function
+
+import json
+import mimetypes
+import os
+import re
+import sys
+from email.utils import formatdate, mktime_tz, parsedate_tz
+
+from iphoto import *
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote, urlsplit
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urlparse import urlsplit
+
+__author__ = "Robert Harder"
+__email__ = "rob@iharder.net"
+__copyright__ = "This code is released into the Public Domain"
+__version__ = "0.1"
+__status__ = "Development"
+
+_COPY_CHUNK = 1024 * 1024
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header, size):
+    """
+    Interprets a Range header against a file of the given size.  Only single
+    ranges are supported; anything else is ignored and the whole file sent.
+    :param str header: eg, bytes=0-1023, bytes=1024- or bytes=-500
+    :param int size: the file's size
+    :return: first and last byte (inclusive), or None to send the whole file
+    :rtype: (int, int)
+    :raises ValueError: if the range lies entirely beyond the end of the file
+    """
+    m = _RANGE.match(header.strip()) if header else None
+    if m is None or (not m.group(1) and not m.group(2)):
+        return None
+    if not m.group(1):  # The last n bytes
+        n = int(m.group(2))
+        if n == 0:
+            raise ValueError("empty suffix range")
+        return max(0, size - n), size - 1
+    start = int(m.group(1))
+    end = int(m.group(2)) if m.group(2) else max(start, size - 1)
+    if end < start:
+        return None  # Not a valid range at all
+    if start >= size:
+        raise ValueError("range starts past the end of the file")
+    return start, min(end, size - 1)
+
+
+def http_date(timestamp):
+    return formatdate(timestamp, usegmt=True)
+
+
+class iPhotoRequestHandler(BaseHTTPRequestHandler):
+    """
+    Answers GET and HEAD requests from the library the server was made with.
+    """
+
+    protocol_version = 'HTTP/1.1'  # Keep connections alive
+    disable_nagle_algorithm = True  # Headers and sendfile() bodies go out separately; don't hold either back
+    server_version = 'pyphotofs/' + __version__
+
+    _ck_http_listing = '_ck_http_listing'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def _respond(self, send_body):
+        path = unquote(urlsplit(self.path).path)
+        try:
+            lib = self.server.library.generation  # Pin one generation for the whole request
+        except LibraryNotLoaded:
+            self._send_empty(503, [('Retry-After', '5')])
+            return
+
+        parts = [p for p in path.split('/') if p]
+        if len(parts) <= 2:
+            listing = self._listing(lib, parts)
+            if listing is None:
+                self._send_empty(404)
+            else:
+                self._send_listing(lib, listing, send_body)
+            return
+
+        collection = lib.collection(parts[0], parts[1]) if parts[0] in ('Albums', 'Rolls') else None
+        image = collection.image_by_filename('/'.join(parts[2:])) if collection is not None else None
+        if image is None:
+            self._send_empty(404)
+            return
+        try:
+            fp = open(image.abspath, 'rb')
+        except (IOError, OSError):
+            self._send_empty(404)
+            return
+        with fp:
+            self._send_file(fp, send_body)
+
+    def _listing(self, lib, parts):
+        """
+        Renders a folder listing as JSON, once per generation.
+        :param iphoto.iPhotoLibraryGeneration lib: the generation this request pinned
+        :param [str] parts: the path, split on /
+        :return: JSON, or None if there is no such folder
+        :rtype: bytes
+        """
+        key = '/'.join(parts)
+        listing = lib.cache.get(self._ck_http_listing, key)
+        if listing is not None:
+            return listing
+
+        entries = []
+        if not parts:
+            for c_type in ('Albums', 'Rolls'):
+                entries.append({'name': c_type, 'type': 'folder', 'count': lib.num_collections(c_type)})
+        elif parts[0] not in ('Albums', 'Rolls'):
+            return None
+        elif len(parts) == 1:
+            for collection in lib.collections(parts[0]):
+                entries.append({'name': collection.name, 'type': 'folder', 'count': collection.num_images})
+        else:
+            collection = lib.collection(parts[0], parts[1])
+            if collection is None:
+                return None
+            for image in collection.images:
+                if image is None:
+                    continue
+                try:
+                    st = os.stat(image.abspath)
+                except OSError:
+                    continue  # Master missing; nothing to serve
+                entries.append({'name': image.filename, 'type': 'file', 'size': st.st_size,
+                                'mtime': int(st.st_mtime)})
+        listing = json.dumps({'path': '/' + key, 'entries': entries}, indent=1).encode('utf-8')
+        return lib.cache.set(self._ck_http_listing, key, listing)
+
+    def _not_modified(self, etag, mtime):
+        """
+        Whether the client's cached copy, described by If-None-Match or If-Modified-Since, is current.
+        """
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            return '*' in tags or etag in tags or ('W/' + etag) in tags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            parsed = parsedate_tz(if_modified_since)
+            return parsed is not None and int(mtime) <= mktime_tz(parsed)
+        return False
+
+    def _send_empty(self, code, headers=()):
+        """
+        Sends a response with no body.  Unlike send_error, this leaves the connection open.
+        """
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _send_validators(self, etag, mtime):
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', http_date(mtime))
+
+    def _send_listing(self, lib, listing, send_body):
+        etag = '"g{:x}-{:x}"'.format(int(lib.mtime), lib.change_number)
+        if self._not_modified(etag, lib.mtime):
+            self.send_response(304)
+            self._send_validators(etag, lib.mtime)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(listing)))
+        self._send_validators(etag, lib.mtime)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(listing)
+
+    def _send_file(self, fp, send_body):
+        st = os.fstat(fp.fileno())
+        etag = '"{:x}-{:x}-{:x}"'.format(st.st_ino, st.st_size, int(st.st_mtime))
+        if self._not_modified(etag, st.st_mtime):
+            self.send_response(304)
+            self._send_validators(etag, st.st_mtime)
+            self.end_headers()
+            return
+
+        byte_range = None
+        if_range = self.headers.get('If-Range')
+        if if_range is None or if_range.strip() in (etag, http_date(st.st_mtime)):
+            try:
+                byte_range = parse_range(self.headers.get('Range'), st.st_size)
+            except ValueError:
+                self._send_empty(416, [('Content-Range', 'bytes */{}'.format(st.st_size))])
+                return
+
+        if byte_range is None:
+            start, length = 0, st.st_size
+            self.send_response(200)
+        else:
+            start, length = byte_range[0], byte_range[1] - byte_range[0] + 1
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(byte_range[0], byte_range[1], st.st_size))
+        self.send_header('Content-Type', mimetypes.guess_type(fp.name)[0] or 'application/octet-stream')
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        self._send_validators(etag, st.st_mtime)
+        self.end_headers()
+        if send_body and length:
+            self._copy(fp, start, length)
+
+    def _copy(self, fp, offset, count):
+        """
+        Sends count bytes of fp from offset, with sendfile() where the platform has it.
+        """
+        self.wfile.flush()
+        sendfile = getattr(self.connection, 'sendfile', None)
+        if sendfile is not None:
+            sendfile(fp, offset, count)
+            return
+        fp.seek(offset)
+        while count > 0:
+            chunk = fp.read(min(_COPY_CHUNK, count))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            count -= len(chunk)
+
+
+class iPhotoHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    A thread per connection, each serving from whatever generation of the library is current.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128  # Many clients may connect at once
+
+    def __init__(self, library, address=('127.0.0.1', 8080), verbose=False):
+        """
+        :param iphoto.iPhotoLibrary library: the library to serve
+        :param (str, int) address: host and port to listen on; port 0 picks a free one
+        """
+        self.library = library
+        self.verbose = verbose
+        HTTPServer.__init__(self, address, iPhotoRequestHandler)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+
+def serve_iphotofs(library, host='127.0.0.1', port=8080, verbose=False):
+    """
+    Serves a library over HTTP until interrupted.
+    :param iphoto.iPhotoLibrary library: the library to serve
+    """
+    server = iPhotoHTTPServer(library, (host, port), verbose=verbose)
+    print("Serving", str(library), "at", server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    if len(sys.argv) < 2:
+        print('usage: %s iphotolibrary [[host:]port]' % sys.argv[0])
+        print("""
+            Serves the library read-only over HTTP, laid out as /Albums/<name>/<file>
+            and /Rolls/<name>/<file>.  Folders are listed as JSON.  Listens on
+            127.0.0.1:8080 unless told otherwise; use 0.0.0.0:port to serve other hosts.
+        """)
+        exit(1)
+    host, port = '127.0.0.1', 8080
+    if len(sys.argv) > 2:
+        address = sys.argv[2]
+        if ':' in address:
+            host, _, address = address.rpartition(':')
+        port = int(address)
+    lib = iPhotoLibrary(sys.argv[1], background=True, load_timeout=30)
+    serve_iphotofs(lib, host, port)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,9 +14,84 @@ __version__ = "0.1"
 __status__ = "Development"
 
 
+def parse_mount_options(argv):
+    """
+    Pulls any "-o opt1,opt2=value" arguments, as the native mount command
+    passes them, out of the argument list.
+    :param [str] argv: the command line arguments
+    :return: the remaining positional arguments and a dictionary of options
+    :rtype: ([str], dict)
+    """
+    args = []
+    options = {}
+    i = 0
+    while i < len(argv):
+        if argv[i] == '-o' and i + 1 < len(argv):
+            for opt in argv[i + 1].split(','):
+                key, _, value = opt.partition('=')
+                options[key] = value if value else True
+            i += 2
+        else:
+            args.append(argv[i])
+            i += 1
+    return args, options
+
+
+_TRUE = ('1', 'true', 'yes', 'on')
+_FALSE = ('0', 'false', 'no', 'off')
+
+
+def bool_option(options, name):
+    """
+    Reads an on/off option, given bare or as name=1|true|yes|on or name=0|false|no|off.
+    :rtype: bool
+    :raises ValueError: for any other value
+    """
+    value = options.get(name, False)
+    if isinstance(value, bool):
+        return value
+    if value.lower() in _TRUE:
+        return True
+    if value.lower() in _FALSE:
+        return False
+    raise ValueError("{}={}: expected one of {}".format(name, value, ', '.join(_TRUE + _FALSE)))
+
+
+def page_size_option(options):
+    """
+    Reads the pages[=N] option.
+    :return: images per page folder, or None not to split collections into pages
+    :rtype: int
+    :raises ValueError: if the value is neither on/off nor a number
+    """
+    pages = options.get('pages', False)
+    if pages is True or (pages and pages.lower() in _TRUE[1:]):
+        return 1000
+    if not pages or pages.lower() in _FALSE:
+        return None
+    try:
+        return max(int(pages), 0) or None
+    except ValueError:
+        raise ValueError("pages={}: expected a number of photos per folder".format(pages))
+
+
+def fs_options_from(options):
+    """
+    Reads the mount options that are passed on to iPhoto_FUSE_FS.
+    :return: edited, duplicates, sidecars and page_size
+    :rtype: dict
+    :raises ValueError: if any of them has a value that doesn't make sense
+    """
+    return dict(edited=bool_option(options, 'edited'),
+                duplicates=bool_option(options, 'duplicates'),
+                sidecars=bool_option(options, 'sidecars'),
+                page_size=page_size_option(options))
+
+
 def main():
-    if len(sys.argv) < 2:
-        print('usage: %s iphotolibrary [mountpoint]' % sys.argv[0])
+    args, options = parse_mount_options(sys.argv[1:])
+    if len(args) < 1:
+        print('usage: %s iphotolibrary [mountpoint] [-o option[,option...]]' % sys.argv[0])
         print("""
             If mountpoint is not specified or a dash -, a mount point will be made
             at the host system's default location (or best guess)
@@ -25,15 +100,92 @@ def main():
             If mountpoint begins with a dash, then a mount point will be created
             automatically within the folder specified after the dash, eg,
             mount_iphotofs ~/Pictures/iPhotoLibrary.photolibrary -.
+
+            If iphotolibrary is a folder containing several libraries rather than
+            a library itself, every library in it is served from the one mount
+            as /<LibraryName>/Albums and /<LibraryName>/Rolls.
+
+            Options:
+                engine=threads|trio   threads (default) uses fusepy; trio uses
+                                      pyfuse3 and serves requests as async tasks
+                                      (one library only)
+                idle=SECONDS          with several libraries, unload a library
+                                      after this long without access (600)
+                cache_entries=N       with several libraries, the memory budget
+                                      they share, in cached objects (250000)
+                negative_timeout=SECONDS
+                                      how long the kernel may remember that a name
+                                      doesn't exist (30)
+                edited                serve each photo as last edited in iPhoto
+                                      instead of the original master
+                duplicates            add a Duplicates folder with a subfolder for
+                                      each set of byte-identical photos
+                sidecars              add a <photo>.json file of metadata (caption,
+                                      rating, dates, albums...) next to each photo
+                pages[=N]             split albums and rolls of more than N photos
+                                      (1000) into subfolders of N, eg, 000001-001000
+                load_timeout=SECONDS  the library is loaded in the background so the
+                                      mount appears at once; requests that need it
+                                      wait this long before failing with EAGAIN (30)
+                trace=FILE            record every operation to FILE for replaying
+                                      later with optrace.py (threads engine and
+                                      one library only)
+                control[=SOCKET]      take commands from control.py (profiling,
+                                      tracing, cache sizes) on a UNIX socket, by
+                                      default control.sock in the library's cache
+                                      folder (threads engine and one library only)
+
+            On/off options such as edited may also be written edited=yes or
+            edited=no (or 1/0, true/false, on/off).
         """)
         exit(1)
 
-    lib = iPhotoLibrary(sys.argv[1])
-    if len(sys.argv) > 2:
-        mount = sys.argv[2]
+    if len(args) > 1:
+        mount = args[1]
     else:
         mount = None
-    mount_iphotofs(lib, mount, foreground=True)
+
+    try:
+        fs_options = fs_options_from(options)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        exit(1)
+    engine = options.get('engine', 'threads')
+    negative_timeout = float(options.get('negative_timeout', 30))
+
+    if not os.path.isfile(os.path.join(args[0], 'AlbumData.xml')):
+        from iphotofuse_multi import find_libraries, library_name, mount_iphotofs_multi
+        idle_seconds = int(options.get('idle', 600))
+        max_entries = int(options.get('cache_entries', 250000))
+        try:
+            mount_iphotofs_multi(find_libraries(args[0]), mount, name=library_name(args[0]), foreground=True,
+                                 idle_seconds=idle_seconds, max_entries=max_entries, engine=engine,
+                                 negative_timeout=negative_timeout, trace=options.get('trace'),
+                                 control=options.get('control'), **fs_options)
+        except ValueError as e:  # An option that can't be used with several libraries
+            print(e, file=sys.stderr)
+            exit(1)
+        return
+
+    trace = None
+    if options.get('trace'):
+        from optrace import TraceRecorder
+        trace = TraceRecorder(options['trace'])
+    lib = iPhotoLibrary(args[0], background=True, load_timeout=float(options.get('load_timeout', 30)))
+    control = options.get('control')
+    if control is True:
+        from control import CONTROL_SOCKET_NAME
+        control = os.path.join(lib.cache_dir, CONTROL_SOCKET_NAME)
+        print("Control socket:", control)
+    try:
+        mount_iphotofs(lib, mount, foreground=True, engine=engine, negative_timeout=negative_timeout,
+                       trace=trace, control=control, **fs_options)
+    except ValueError as e:  # An option the chosen engine can't honor
+        print(e, file=sys.stderr)
+        exit(1)
+    finally:
+        if trace is not None:
+            trace.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# Python 3, or Python 2 with the futures backport
+"""
+Records the filesystem operations clients send to a mount, and replays them.
+
+A trace is a JSON Lines file with one operation per line: when it started
+(seconds since recording began), the op, its path, size/offset for reads,
+the file handle, how long it took in microseconds and the errno if it
+failed.  Each recording starts a new file.  Replaying drives an iPhoto_FUSE_FS object directly, no kernel
+mount needed, either at the recorded pace (optionally sped up) or as fast
+as possible, and reports latency percentiles for each kind of operation
+next to those that were recorded.  Record on a mount that is misbehaving,
+then replay against a change to see whether it helps.
+
+    optrace.py iphotolibrary trace.jsonl [speed] [-o edited,sidecars,...]
+"""
+from __future__ import print_function
+
+import errno
+import json
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from iphotofuse import *
+from iphotofuse import _ContextFreeFS
+
+__author__ = "Robert Harder"
+__email__ = "rob@iharder.net"
+__copyright__ = "This code is released into the Public Domain"
+__version__ = "0.1"
+__status__ = "Development"
+
+_FLUSH_SECONDS = 1.0
+
+# What fusepy answers when an operation raises something other than OSError
+_UNCAUGHT_ERRNO = errno.EFAULT
+
+# Ops that return a file handle, and those that are passed one as their last argument
+_FH_RESULT_OPS = ('open',)
+_FH_ARG_OPS = ('read', 'release', 'flush', 'fsync')
+
+
+class TraceRecorder(object):
+    """
+    Writes every operation an iPhoto_FUSE_FS performs to a trace file.
+    Safe to use from many threads at once.
+    """
+
+    def __init__(self, path):
+        """
+        :param str path: the trace file, replaced if it exists, since times and
+                         handles from another session wouldn't line up with these
+        """
+        self.path = path
+        self._fp = open(path, 'w')
+        self._lock = Lock()
+        self._started = time.time()
+        self._last_flush = self._started
+        self.count = 0
+
+    def __str__(self):
+        return "[TraceRecorder {}, {} ops]".format(self.path, self.count)
+
+    def call(self, func, op, args):
+        """
+        Performs an operation, recording it whether it succeeds or fails.
+        :param func: dispatches the operation, eg, iPhoto_FUSE_FS._dispatch
+        :param str op: the operation, eg, getattr
+        :param tuple args: its arguments
+        """
+        started = time.time()
+        result, error = None, None
+        try:
+            result = func(op, *args)
+            return result
+        except OSError as e:
+            error = e.errno
+            raise
+        except Exception:
+            error = _UNCAUGHT_ERRNO
+            raise
+        finally:
+            self.record(op, args, result, started, time.time() - started, error)
+
+    def record(self, op, args, result, started, elapsed, error=None):
+        if op in ('init', 'destroy'):
+            return
+        event = OrderedDict()
+        event['t'] = round(started - self._started, 6)
+        event['op'] = op
+        event['path'] = args[0] if args else None
+        if op == 'read':
+            event['size'], event['offset'] = args[1], args[2]
+        if op in _FH_RESULT_OPS:
+            event['fh'] = result
+        elif op in _FH_ARG_OPS and args:
+            event['fh'] = args[-1]
+        event['us'] = int(elapsed * 1000000)
+        if error is not None:
+            event['err'] = error
+        line = json.dumps(event, separators=(',', ':')) + '\n'
+        with self._lock:
+            if self._fp.closed:
+                return  # Stopped while this operation was under way
+            self._fp.write(line)
+            self.count += 1
+            if started - self._last_flush > _FLUSH_SECONDS:
+                self._fp.flush()
+                self._last_flush = started
+
+    def close(self):
+        with self._lock:
+            self._fp.close()
+
+
+def read_trace(path):
+    """
+    Reads the operations in a trace file, skipping any line cut short by a crash.
+    :rtype: [dict]
+    """
+    events = []
+    with open(path) as fp:
+        for line in fp:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue
+    return events
+
+
+def percentiles(values, fractions=(0.5, 0.9, 0.99, 1.0)):
+    values = sorted(values)
+    if not values:
+        return [0] * len(fractions)
+    return [values[min(len(values) - 1, int(f * len(values)))] for f in fractions]
+
+
+def replay_args(event, fh=None):
+    """
+    Rebuilds the arguments of a recorded operation.
+    :param int fh: the replay's own handle standing in for the recorded one
+    :rtype: tuple
+    """
+    op, path = event['op'], event['path']
+    if op == 'read':
+        return path, event['size'], event['offset'], fh
+    if op == 'fsync':
+        return path, 0, fh
+    if op in _FH_ARG_OPS:
+        return path, fh
+    if op in ('open', 'access', 'releasedir'):
+        return path, 0
+    if op == 'readdir':
+        return path, None
+    return path,
+
+
+def replay(fs, events, speed=1.0, workers=32):
+    """
+    Performs the operations in a trace against a filesystem object.  Operations
+    start at their recorded times (divided by speed) on a pool of threads, so they
+    overlap as they originally did; those on the same file handle are kept in order.
+    :param iPhoto_FUSE_FS fs: the filesystem to drive
+    :param [dict] events: the operations, from read_trace
+    :param float speed: 2 replays twice as fast as recorded; 0 as fast as possible
+    :param int workers: most operations in flight at once
+    :return: op -> replayed latencies in seconds, and the number of ops whose outcome
+             (success or errno) differed from the recording
+    :rtype: (OrderedDict, int)
+    """
+    latencies = OrderedDict()
+    mismatches = [0]
+    lock = Lock()
+
+    def perform(event, fh=None):
+        args = replay_args(event, fh)
+        started = time.time()
+        error = None
+        try:
+            result = fs(event['op'], *args)
+        except OSError as e:
+            result, error = None, e.errno
+        except Exception:
+            result, error = None, _UNCAUGHT_ERRNO
+        elapsed = time.time() - started
+        with lock:
+            latencies.setdefault(event['op'], []).append(elapsed)
+            if error != event.get('err'):
+                mismatches[0] += 1
+        return result
+
+    def open_unrecorded(path):
+        try:
+            return fs('open', path, 0)
+        except OSError:
+            return None
+
+    def perform_on_handle(event, opened, earlier):
+        for future in earlier:  # Keep operations on one handle in their recorded order
+            future.result()
+        fh = opened.result()
+        return perform(event, fh) if fh is not None else None
+
+    opened = {}  # Recorded handle -> future of the replay's handle
+    pending = {}  # Recorded handle -> futures of operations on it not yet known to be done
+    begin = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for event in events:
+            if speed:
+                delay = begin + event['t'] / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            op, fh = event['op'], event.get('fh')
+            if op in _FH_RESULT_OPS and fh is not None:
+                opened[fh] = pool.submit(perform, event)
+                pending[fh] = []
+            elif op in _FH_ARG_OPS and fh is not None:
+                if fh not in opened:  # Opened before recording began
+                    opened[fh] = pool.submit(open_unrecorded, event['path'])
+                    pending[fh] = []
+                earlier = [f for f in pending[fh] if not f.done()]
+                pending[fh] = earlier + [pool.submit(perform_on_handle, event, opened[fh], earlier)]
+                if op == 'release':
+                    del opened[fh], pending[fh]
+            else:
+                pool.submit(perform, event)
+        for fh, future in opened.items():  # Never released in the trace; don't leak them
+            for earlier in pending[fh]:
+                earlier.result()
+            if future.result() is not None:
+                fs.release(None, future.result())
+    return latencies, mismatches[0]
+
+
+def report(events, latencies, mismatches, elapsed):
+    recorded = OrderedDict()
+    for event in events:
+        recorded.setdefault(event['op'], []).append(event.get('us', 0) / 1000000.0)
+    print("{:10s} {:>7s} {:>29s}   {:>29s}".format('', '', 'replayed p50/p90/p99/max ms',
+                                                   'recorded p50/p90/p99/max ms'))
+    for op, values in latencies.items():
+        print("{:10s} {:7d} {:>29s}   {:>29s}".format(
+            op, len(values),
+            '/'.join('{:.2f}'.format(1000 * v) for v in percentiles(values)),
+            '/'.join('{:.2f}'.format(1000 * v) for v in percentiles(recorded.get(op, [])))))
+    total = sum(len(v) for v in latencies.values())
+    print("{} ops in {:.2f}s ({:.0f} ops/s), {} with a different outcome than recorded".format(
+        total, elapsed, total / elapsed if elapsed else 0, mismatches))
+
+
+def main():
+    from mount_iphotofs import fs_options_from, parse_mount_options
+    args, options = parse_mount_options(sys.argv[1:])
+    if len(args) < 2:
+        print(__doc__)
+        print("""
+            speed: 1 (default) replays at the recorded pace, 10 ten times faster,
+            and 0 as fast as possible.  Options are those of mount_iphotofs
+            (edited, duplicates, sidecars, pages); use the ones the trace was recorded with.
+        """)
+        exit(1)
+    try:
+        fs_options = fs_options_from(options)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        exit(1)
+    events = read_trace(args[1])
+    speed = float(args[2]) if len(args) > 2 else 1.0
+    library = iPhotoLibrary(args[0])
+    fs = _ContextFreeFS(library, **fs_options)
+    start = time.time()
+    latencies, mismatches = replay(fs, events, speed=speed)
+    report(events, latencies, mismatches, time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# Should work with Python 2 or 3
+"""
+JSON metadata sidecars for images, rendered from the library model.
+
+A sidecar's size is needed for every getattr, but rendering one just to
+measure it would make listing a big album slow, so each size is worked out
+once per library generation and kept in that generation's cache.  Rendered
+bytes go into a bounded LRU so that bulk reads (cat, rsync) of many
+sidecars don't render each one twice.
+"""
+import json
+from collections import OrderedDict
+from threading import Lock
+
+__author__ = "Robert Harder"
+__email__ = "rob@iharder.net"
+__copyright__ = "This code is released into the Public Domain"
+__version__ = "0.1"
+__status__ = "Development"
+
+SIDECAR_EXTENSION = '.json'
+
+
+def _iso(dt):
+    return dt.isoformat() if dt is not None else None
+
+
+def render_sidecar(lib, image):
+    """
+    Renders an image's metadata as JSON.
+    :param iphoto.iPhotoLibrary lib: the library (generation) the image came from
+    :param iphoto.iPhotoImage image: the image
+    :rtype: bytes
+    """
+    meta = OrderedDict()
+    meta['filename'] = image.filename
+    meta['guid'] = image.guid
+    meta['caption'] = image.caption
+    meta['comment'] = image.comment
+    meta['rating'] = image.rating
+    meta['type'] = image.type
+    meta['date'] = _iso(image.date)
+    meta['modified_date'] = _iso(image.modified_date)
+    meta['roll_id'] = image.roll_id
+    meta['albums'] = lib.album_names_containing(image)
+    meta['path'] = image.relpath
+    return (json.dumps(meta, indent=2) + '\n').encode('utf-8')
+
+
+class SidecarCache(object):
+    """
+    Renders sidecars and remembers their sizes and, within a byte budget, their contents.
+    """
+
+    _ck_sidecar_size_by_guid = '_ck_sidecar_size_by_guid'
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._rendered = OrderedDict()  # (generation number, guid) -> bytes, least recently used first
+        self._rendered_bytes = 0
+        self._lock = Lock()
+
+    def __str__(self):
+        return "[SidecarCache {} sidecars, {} bytes]".format(len(self._rendered), self._rendered_bytes)
+
+    def content(self, lib, image):
+        """
+        Returns a sidecar's contents.
+        :param iphoto.iPhotoLibraryGeneration lib: the generation the image came from
+        :param iphoto.iPhotoImage image: the image
+        :rtype: bytes
+        """
+        key = (lib.number, image.guid)
+        with self._lock:
+            data = self._rendered.pop(key, None)
+            if data is not None:
+                self._rendered[key] = data
+                return data
+
+        data = render_sidecar(lib, image)
+        lib.cache.set(self._ck_sidecar_size_by_guid, image.guid, len(data))
+        with self._lock:
+            if key not in self._rendered and len(data) <= self.max_bytes:
+                self._rendered[key] = data
+                self._rendered_bytes += len(data)
+                while self._rendered_bytes > self.max_bytes:
+                    _, old = self._rendered.popitem(last=False)
+                    self._rendered_bytes -= len(old)
+        return data
+
+    def size(self, lib, image):
+        """
+        Returns a sidecar's size, rendering it only the first time in a generation.
+        :param iphoto.iPhotoLibraryGeneration lib: the generation the image came from
+        :param iphoto.iPhotoImage image: the image
+        :rtype: int
+        """
+        size = lib.cache.get(self._ck_sidecar_size_by_guid, image.guid)
+        if size is None:
+            size = len(self.content(lib, image))
+        return size
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# Python 3.8+ (queries are keyed archives, which older plistlibs can't read)
+"""
+Evaluates smart albums from their definitions in Database/Albums.
+
+AlbumData.xml lists a smart album's photos as they were when iPhoto last
+wrote the file.  Each album's .apalbum plist holds the query itself, as a
+keyed archive of nested conditions, so the album's photos can be worked
+out again from the library's current ratings, captions and so on.
+Conditions are tested against a MetadataTable, built once per generation,
+that keeps each attribute a query can test in its own column, with
+ratings indexed by value.  A condition is only evaluated once the meaning
+of its comparison code has been checked against a query iPhoto itself
+archived and the album it filled; so far none has, so every smart album
+keeps the snapshot AlbumData.xml has, as do albums whose queries test
+anything not in AlbumData.xml (color labels, say).
+
+    smartalbums.py iphotolibrary
+"""
+from __future__ import print_function
+
+import os
+import plistlib
+import sys
+from collections import OrderedDict
+from threading import Lock
+
+try:
+    from .iphoto import *
+except (ImportError, ValueError):  # Not imported as part of the pyphotofs package
+    from iphoto import *
+
+__author__ = "Robert Harder"
+__email__ = "rob@iharder.net"
+__copyright__ = "This code is released into the Public Domain"
+__version__ = "0.1"
+__status__ = "Development"
+
+ALBUM_SUBCLASS_SMART = 2
+MATCH_ANY = 0
+MATCH_ALL = 1
+
+# Comparison codes seen in the queries iPhoto archives, with what they appear to mean.
+# 5 is used for flags and color labels, 23 for text and 8 for ratings (with 0 in album
+# filters and -1, rejected, for the Trash), but no album iPhoto filled has yet confirmed
+# any of them: 8 could as well be at most as at least.
+QUALIFIER_IS = 5
+QUALIFIER_AT_LEAST = 8
+QUALIFIER_CONTAINS = 23
+
+# queryPropertyKey -> the MetadataTable column it tests
+_COLUMNS = {
+    'basicProperties.MainRating': 'rating',
+    'isFlagged': 'flagged',
+    'properties.any': 'text',
+}
+# (column, qualifier) pairs checked against a real archived query and the album iPhoto
+# filled with it.  Add a pair only with a fixture that shows what it means.
+_SUPPORTED = frozenset()
+_LIBRARY_SCOPE = 'LibraryFolder'  # queryFolderUuid of a query over the whole library
+
+
+class UnsupportedQuery(Exception):
+    """
+    A smart album's query tests something this module can't evaluate.
+    """
+    pass
+
+
+def unarchive(data):
+    """
+    Decodes an NSKeyedArchiver archive into plain dictionaries, lists, strings and numbers.
+    Dates stay as seconds since 1 Jan 2001, like AlbumData.xml's *AsTimerInterval values.
+    :param bytes data: the archive, a binary plist
+    """
+    archive = plistlib.loads(data)
+    objects = archive['$objects']
+
+    def decode(value):
+        if isinstance(value, plistlib.UID):
+            value = objects[value.data]
+        if isinstance(value, dict):
+            if 'NS.keys' in value:
+                return dict((decode(k), decode(v)) for k, v in zip(value['NS.keys'], value['NS.objects']))
+            if 'NS.objects' in value:
+                return [decode(v) for v in value['NS.objects']]
+            if 'NS.string' in value:
+                return value['NS.string']
+            if 'NS.time' in value:
+                return value['NS.time']
+            return dict((k, decode(v)) for k, v in value.items() if k != '$class')
+        if isinstance(value, list):
+            return [decode(v) for v in value]
+        return None if value == '$null' else value
+
+    return decode(archive['$top']['root'])
+
+
+def compile_query(query):
+    """
+    Turns an unarchived query into nested tuples: ('all' or 'any', [conditions])
+    for a group and (column, qualifier, value) for a single test.  Disabled
+    conditions are left out.
+    :param dict query: from unarchive
+    :rtype: tuple
+    :raises UnsupportedQuery: if any enabled condition can't be evaluated
+    """
+    kind = query.get('queryClassName')
+    if kind == 'RKMultiItemQuery':
+        conditions = [compile_query(q) for q in query.get('querySubqueries') or [] if q.get('queryIsEnabled')]
+        return 'all' if query.get('queryMatchType') == MATCH_ALL else 'any', conditions
+    if kind == 'RKSingleItemQuery':
+        key, qualifier = query.get('queryPropertyKey'), query.get('queryQualifier')
+        column = _COLUMNS.get(key)
+        if column is None:
+            raise UnsupportedQuery("can't test {}".format(key))
+        if (column, qualifier) not in _SUPPORTED:
+            raise UnsupportedQuery("can't test {} with unverified qualifier {}".format(key, qualifier))
+        return column, qualifier, query.get('queryFirstValue')
+    raise UnsupportedQuery("unknown kind of query {}".format(kind))
+
+
+def _columns(conditions):
+    if conditions[0] in ('all', 'any'):
+        columns = set()
+        for condition in conditions[1]:
+            columns.update(_columns(condition))
+        return columns
+    return set([conditions[0]])
+
+
+class SmartAlbum(object):
+    """
+    A smart album as defined in its .apalbum plist.
+    """
+
+    def __init__(self, uuid, name, query):
+        """
+        :param str uuid: the album's uuid, which is its GUID in AlbumData.xml
+        :param str name: the album's name
+        :param dict query: the unarchived UserQueryInfo
+        """
+        self.uuid = uuid
+        self.name = name
+        self.query = query
+        self.unsupported = None  # Why the query can't be evaluated, if it can't
+        try:
+            self.conditions = compile_query(query)
+            self.columns = tuple(sorted(_columns(self.conditions)))
+        except UnsupportedQuery as e:
+            self.conditions, self.columns, self.unsupported = None, (), str(e)
+
+    def __str__(self):
+        return "[Smart Album '{}', {}]".format(
+            self.name, 'tests ' + ', '.join(self.columns) if self.unsupported is None else self.unsupported)
+
+
+def read_smart_albums(library_path):
+    """
+    Reads the definitions of a library's smart albums.  Magic albums such as
+    the Trash, whose queries don't say everything about what is in them, are
+    left out.
+    :param str library_path: path to the .photolibrary folder
+    :return: uuid -> definition
+    :rtype: OrderedDict
+    """
+    albums = OrderedDict()
+    albums_dir = os.path.join(library_path, 'Database', 'Albums')
+    if not hasattr(plistlib, 'UID') or not os.path.isdir(albums_dir):
+        return albums
+    for name in sorted(os.listdir(albums_dir)):
+        if not name.endswith('.apalbum'):
+            continue
+        try:
+            with open(os.path.join(albums_dir, name), 'rb') as fp:
+                plist = read_plist(fp)
+            info = plist.get('InfoDictionary', {})
+            if info.get('albumSubclass') != ALBUM_SUBCLASS_SMART or info.get('isMagic') or info.get('isInTrash'):
+                continue
+            if not info.get('name') or 'UserQueryInfo' not in plist:
+                continue
+            query = unarchive(plist['UserQueryInfo'])
+        except Exception:
+            continue  # Mid-save perhaps; AlbumData.xml's snapshot will have to do
+        album = SmartAlbum(info.get('uuid'), info['name'], query)
+        if info.get('queryFolderUuid', _LIBRARY_SCOPE) != _LIBRARY_SCOPE:
+            album.conditions, album.columns = None, ()
+            album.unsupported = "searches only within folder {}".format(info['queryFolderUuid'])
+        albums[album.uuid] = album
+    return albums
+
+
+class MetadataTable(object):
+    """
+    The attributes smart album queries test, one column per attribute, for
+    every image in one generation.  A column is built the first time a query
+    needs it.
+    """
+
+    def __init__(self, lib):
+        """
+        :param iphoto.iPhotoLibraryGeneration lib: the generation
+        """
+        self._plist = lib._plist
+        self._images = lib._plist.get('Master Image List', {})
+        self._columns = {}
+        self._digests = {}
+        self._lock = Lock()
+
+    def __str__(self):
+        return "[MetadataTable {} images, columns {}]".format(len(self._images), ', '.join(sorted(self._columns)))
+
+    def column(self, name):
+        """
+        :param str name: 'rating' (rating -> [image ID]), 'flagged' (set of image IDs)
+                         or 'text' ([(image ID, lowercase caption, comment, file name and keywords)])
+        """
+        with self._lock:
+            column = self._columns.get(name)
+            if column is None:
+                column = self._columns[name] = getattr(self, '_build_' + name)()
+            return column
+
+    def _build_rating(self):
+        index = {}
+        for img_id, img in self._images.items():
+            index.setdefault(img.get('Rating', 0), []).append(img_id)
+        return index
+
+    def _build_flagged(self):
+        flagged = set()
+        for album in self._plist.get('List of Albums', []):
+            if album.get('Album Type') == 'Flagged':
+                flagged.update(str(img_id) for img_id in album.get('KeyList', []))
+        return frozenset(flagged)
+
+    def _build_text(self):
+        keywords = self._plist.get('List of Keywords', {})
+        rows = []
+        for img_id, img in self._images.items():
+            words = [img.get('Caption') or '', img.get('Comment') or '', os.path.basename(img.get('ImagePath') or '')]
+            words += [keywords.get(str(k), '') for k in img.get('Keywords', [])]
+            rows.append((img_id, '\n'.join(words).lower()))
+        return rows
+
+    def digest(self, name):
+        """
+        A value that differs between two tables if, and practically only if, the column does.
+        """
+        digest = self._digests.get(name)
+        if digest is None:
+            column = self.column(name)
+            if name == 'rating':
+                digest = hash(tuple((rating, tuple(ids)) for rating, ids in sorted(column.items())))
+            elif name == 'flagged':
+                digest = hash(column)
+            else:
+                digest = hash(tuple(column))
+            self._digests[name] = digest
+        return digest
+
+    def digests(self, names):
+        return tuple(self.digest(name) for name in names)
+
+    def select(self, conditions):
+        """
+        Finds the images that meet some conditions, ordered by date taken as iPhoto shows them.
+        :param tuple conditions: from compile_query
+        :return: image IDs
+        :rtype: [str]
+        """
+        matches = self._matches(conditions)
+        images = self._images
+        if matches is None:
+            matches = images.keys()
+        return sorted(matches, key=lambda img_id: (images[img_id].get('DateAsTimerInterval') or 0, img_id))
+
+    def _matches(self, conditions):
+        """
+        :return: matching image IDs, or None for all of them
+        :rtype: set
+        """
+        if conditions[0] in ('all', 'any'):
+            found = None
+            for condition in conditions[1]:
+                matches = self._matches(condition)
+                if matches is None:
+                    if conditions[0] == 'any':
+                        return None
+                elif found is None:
+                    found = matches
+                elif conditions[0] == 'all':
+                    found = found & matches
+                else:
+                    found = found | matches
+            return found
+
+        column, qualifier, value = conditions
+        if column == 'rating':
+            value = value or 0
+            ids = set()
+            for rating, rating_ids in self.column('rating').items():
+                if rating == value or (qualifier == QUALIFIER_AT_LEAST and rating > value):
+                    ids.update(rating_ids)
+            return ids
+        if column == 'flagged':
+            flagged = self.column('flagged')
+            return set(flagged) if value else set(self._images).difference(flagged)
+        text = (value or '').lower()
+        return set(img_id for img_id, words in self.column('text') if text in words)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        exit(1)
+    lib = iPhotoLibrary(sys.argv[1]).generation
+    albums = lib.smart_albums
+    if not albums:
+        print("No smart albums in", str(lib))
+    for album in albums.values():
+        ids = lib.smart_album_ids(album.uuid)
+        print(str(album), "{} images".format(len(ids)) if ids is not None else "not evaluated")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# Should work with Python 2 or 3
+"""
+Summarizes iPhoto libraries without loading them: name, number of photos,
+album and roll names with their photo counts, and the total size of the
+masters.
+
+iPhotoLibrary parses all of AlbumData.xml into memory, which for a large
+library takes minutes and gigabytes.  For a summary, AlbumData.xml is
+memory-mapped instead and scanned once for just the keys that matter, and
+the size of the masters comes from one query on Database/Library.apdb.
+Many libraries are summarized at once, one JSON line each.
+
+    summary.py iphotolibrary|folder [...] [-jN]
+"""
+from __future__ import print_function
+
+import json
+import mmap
+import os
+import re
+import sqlite3
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import unescape
+
+from iphoto import *
+
+__author__ = "Robert Harder"
+__email__ = "rob@iharder.net"
+__copyright__ = "This code is released into the Public Domain"
+__version__ = "0.1"
+__status__ = "Development"
+
+# The only keys a summary needs, with the string or integer value that follows them, if any
+_TOKEN = re.compile(br'<key>(List of Albums|List of Rolls|Master Image List|List of Faces|List of Keywords|'
+                    br'AlbumName|RollName|PhotoCount|KeyList|ImagePath)</key>\s*'
+                    br'(?:<(?:string|integer)>([^<]*)<|(<array\s*/>))?')
+_SECTIONS = {b'List of Albums': 'albums', b'List of Rolls': 'rolls', b'Master Image List': 'images',
+             b'List of Faces': None, b'List of Keywords': None}
+_NAME_KEYS = {b'AlbumName': 'albums', b'RollName': 'rolls'}
+_ENTITIES = {'&quot;': '"', '&apos;': "'"}
+
+
+def _text(value):
+    return unescape(value.decode('utf-8'), _ENTITIES)
+
+
+def scan_album_data(path):
+    """
+    Reads the number of photos and the album and roll names and counts from
+    an AlbumData.xml in a single pass over it, without parsing the rest.
+    :param str path: the AlbumData.xml
+    :return: number of photos, [(album name, photo count)], [(roll name, photo count)]
+    :rtype: (int, [(str, int)], [(str, int)])
+    """
+    images = 0
+    collections = {'albums': [], 'rolls': []}
+    keylists = {}  # (section, index) -> where its KeyList starts, in case there is no PhotoCount
+    with open(path, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return 0, [], []
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            section = None
+            for m in _TOKEN.finditer(data):
+                key, value = m.group(1), m.group(2)
+                if key in _SECTIONS:
+                    section = _SECTIONS[key]
+                elif key == b'ImagePath':
+                    if section == 'images':
+                        images += 1
+                elif section not in collections:
+                    continue
+                elif key in _NAME_KEYS:
+                    if _NAME_KEYS[key] == section and value is not None:
+                        collections[section].append([_text(value), None])
+                elif not collections[section]:
+                    continue
+                elif key == b'PhotoCount':
+                    if value is not None:
+                        collections[section][-1][1] = int(value)
+                elif key == b'KeyList':
+                    keylists[(section, len(collections[section]) - 1)] = None if m.group(3) else m.end()
+
+            for (section, i), start in keylists.items():
+                entry = collections[section][i]
+                if entry[1] is None:  # Written without a PhotoCount; count the KeyList instead
+                    if start is None:
+                        entry[1] = 0
+                    else:
+                        keylist = data[start:data.find(b'</array>', start)]
+                        entry[1] = keylist.count(b'<string>') + keylist.count(b'<integer>')
+        finally:
+            data.close()
+    return images, [tuple(e) for e in collections['albums']], [tuple(e) for e in collections['rolls']]
+
+
+def master_totals(library_path):
+    """
+    Counts the masters not in the Trash and adds up their sizes, as recorded in Database/Library.apdb.
+    :param str library_path: path to the .photolibrary folder
+    :return: number of masters and total bytes, or (None, None) if Library.apdb can't be read
+    :rtype: (int, int)
+    """
+    db_path = os.path.join(library_path, 'Database', 'Library.apdb')
+    if not os.path.isfile(db_path):
+        return None, None
+    try:
+        conn = sqlite3.connect(db_path)
+        try:
+            count, size = conn.execute('SELECT COUNT(*), SUM(fileSize) FROM RKMaster WHERE isInTrash = 0').fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None, None
+    return count, size or 0
+
+
+def summarize(library_path):
+    """
+    Summarizes a library without loading it.
+    :param str library_path: path to the .photolibrary folder
+    :return: name, path, images, masters, total_size, and albums and rolls ([{name, images}])
+    :rtype: OrderedDict
+    """
+    started = time.time()
+    images, albums, rolls = scan_album_data(os.path.join(library_path, 'AlbumData.xml'))
+    masters, size = master_totals(library_path)
+    summary = OrderedDict()
+    summary['name'] = library_name(library_path)
+    summary['path'] = os.path.abspath(library_path)
+    summary['images'] = images
+    summary['masters'] = masters
+    summary['total_size'] = size
+    summary['albums'] = [OrderedDict([('name', name), ('images', count)]) for name, count in albums]
+    summary['rolls'] = [OrderedDict([('name', name), ('images', count)]) for name, count in rolls]
+    summary['elapsed_seconds'] = round(time.time() - started, 3)
+    return summary
+
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith('-j')]
+    jobs = [int(a[2:]) for a in sys.argv[1:] if a.startswith('-j')]
+    if len(args) < 1:
+        print(__doc__)
+        print("""
+            Each argument is a library, or a folder of libraries.  One line of
+            JSON is printed per library; libraries that can't be read are
+            reported on stderr.  -jN summarizes N libraries at once (default 8).
+        """)
+        exit(1)
+
+    paths = []
+    failed = False
+    for arg in args:
+        if os.path.isfile(os.path.join(arg, 'AlbumData.xml')):
+            paths.append(arg)
+        elif os.path.isdir(arg):
+            paths += find_libraries(arg)
+        else:
+            print("{}: not an iPhoto library or a folder of them".format(arg), file=sys.stderr)
+            failed = True
+
+    def attempt(path):
+        try:
+            return path, summarize(path), None
+        except Exception as e:
+            return path, None, e
+
+    with ThreadPoolExecutor(max_workers=jobs[-1] if jobs else 8) as pool:
+        for path, summary, error in pool.map(attempt, paths):
+            if error is not None:
+                print("{}: {}".format(path, error), file=sys.stderr)
+                failed = True
+            else:
+                print(json.dumps(summary))
+    exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
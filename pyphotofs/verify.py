@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# Python 3, or Python 2 with the futures backport
+"""
+Checks that an iPhoto library is whole before it is backed up or moved.
+
+Every image in the Master Image List must have a readable master of the
+size recorded in Database/Library.apdb, and a readable, non-empty
+thumbnail of the size recorded in Database/ImageProxies.apdb.  Every image an album or roll lists in its KeyList must exist.
+Files are checked by a bounded pool of threads, so on network storage many
+requests are in flight at once; raise the worker count for storage that
+can take more.  Progress goes to stderr and a JSON summary to stdout.
+"""
+from __future__ import print_function
+
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from threading import Lock
+
+from iphoto import *
+
+__author__ = "Robert Harder"
+__email__ = "rob@iharder.net"
+__copyright__ = "This code is released into the Public Domain"
+__version__ = "0.1"
+__status__ = "Development"
+
+MISSING = 'missing'
+UNREADABLE = 'unreadable'
+WRONG_SIZE = 'wrong size'
+EMPTY = 'empty'
+
+
+def _recorded_sizes(db_path, query, folder):
+    if not os.path.isfile(db_path):
+        return None
+    try:
+        conn = sqlite3.connect(db_path)
+        try:
+            rows = conn.execute(query).fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    return dict((os.path.join(folder, path), size) for path, size in rows if path and size is not None)
+
+
+def master_sizes(library):
+    """
+    Reads the size iPhoto recorded for each managed master.
+    :param iphoto.iPhotoLibrary library: the library
+    :return: path relative to the library folder (eg, Masters/2016/...) -> bytes,
+             or None if Library.apdb can't be read
+    :rtype: dict
+    """
+    return _recorded_sizes(os.path.join(library.abspath, 'Database', 'Library.apdb'),
+                           'SELECT imagePath, fileSize FROM RKMaster WHERE fileIsReference = 0', 'Masters')
+
+
+def thumbnail_sizes(library):
+    """
+    Reads the size iPhoto recorded for each thumbnail, both the small ones
+    AlbumData.xml lists as ThumbPath and the larger 1024 pixel ones.
+    :param iphoto.iPhotoLibrary library: the library
+    :return: path relative to the library folder (eg, Thumbnails/2016/...) -> bytes,
+             or None if ImageProxies.apdb can't be read
+    :rtype: dict
+    """
+    return _recorded_sizes(os.path.join(library.abspath, 'Database', 'ImageProxies.apdb'),
+                           'SELECT miniThumbnailPath, miniThumbnailFilesize FROM RKImageProxyState '
+                           'UNION ALL SELECT thumbnailPath, thumbnailFilesize FROM RKImageProxyState', 'Thumbnails')
+
+
+def check_file(path, expected_size=None):
+    """
+    Checks that a file exists, can be read and, if known, is the expected size.
+    :return: None if all is well, otherwise what is wrong (MISSING, UNREADABLE, WRONG_SIZE or EMPTY)
+    :rtype: str
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return MISSING if not os.path.lexists(path) else UNREADABLE
+    try:
+        size = os.fstat(fd).st_size
+        if size and not os.read(fd, 1):
+            return UNREADABLE
+    except OSError:
+        return UNREADABLE
+    finally:
+        os.close(fd)
+    if expected_size is not None and size != expected_size:
+        return WRONG_SIZE
+    if size == 0:
+        return EMPTY
+    return None
+
+
+class VerifyReport(object):
+    """
+    Running totals for a verification.  Updated from the worker threads.
+    """
+
+    def __init__(self, library):
+        self.library = library.abspath
+        self.images = 0
+        self.files_total = 0
+        self.files_checked = 0
+        self.sizes_checked = False
+        self.problems = []  # dicts describing each file or reference that is wrong
+        self.started = time.time()
+        self.finished = None
+        self._lock = Lock()
+
+    def __str__(self):
+        return "[Verify {}/{} files checked, {} problems, {:.1f}s]".format(
+            self.files_checked, self.files_total, len(self.problems), self.elapsed)
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def ok(self):
+        return not self.problems
+
+    def _add(self, checked=0, problem=None):
+        with self._lock:
+            self.files_checked += checked
+            if problem is not None:
+                self.problems.append(problem)
+
+    def as_dict(self):
+        """
+        A summary for other programs to read.
+        :rtype: dict
+        """
+        with self._lock:
+            problems = list(self.problems)
+        counts = {}
+        for problem in problems:
+            key = '{} {}'.format(problem['kind'], problem['problem'])
+            counts[key] = counts.get(key, 0) + 1
+        return {'library': self.library, 'ok': not problems, 'images': self.images,
+                'files_checked': self.files_checked, 'sizes_checked': self.sizes_checked,
+                'elapsed_seconds': round(self.elapsed, 3), 'problem_counts': counts, 'problems': problems}
+
+
+def _file_jobs(lib, sizes):
+    """
+    Yields (kind, image id, image, path, expected size) for each file that should exist.
+    Files in the library are looked for under the library's current path, not
+    the one recorded in AlbumData.xml, which is stale if the library has been
+    renamed or moved.
+    """
+    for img_id, img_plist in lib._plist.get('Master Image List', {}).items():
+        image = iPhotoImage(img_plist, lib)
+        master = image.relpath
+        if master is not None:
+            yield 'master', img_id, image, os.path.join(lib.abspath, master), \
+                sizes.get(master) if sizes is not None else None
+        else:  # Referenced rather than copied into the library
+            yield 'master', img_id, image, image.declared_image_path, None
+        if img_plist.get('ThumbPath'):
+            thumb = image.thumb_relpath
+            if thumb is not None:
+                yield 'thumbnail', img_id, image, os.path.join(lib.abspath, thumb), \
+                    sizes.get(thumb) if sizes is not None else None
+            else:  # Not in any library; it will show up as missing unless it happens to be there
+                yield 'thumbnail', img_id, image, img_plist['ThumbPath'], None
+
+
+def verify_library(library, workers=16, progress=None, progress_interval=1.0):
+    """
+    Checks every master, thumbnail and album or roll reference in a library.
+    :param iphoto.iPhotoLibrary library: the library
+    :param int workers: number of files to check at once
+    :param progress: called with the report now and then while checking
+    :return: what was checked and what is wrong
+    :rtype: VerifyReport
+    """
+    lib = library.generation
+    report = VerifyReport(lib)
+    images = lib._plist.get('Master Image List', {})
+    report.images = len(images)
+
+    for c_type in ('Albums', 'Rolls'):
+        for collection in lib.collections(c_type):
+            for img_id in collection.image_ids:
+                if str(img_id) not in images:
+                    report._add(problem={'kind': c_type[:-1].lower(), 'problem': 'dangling key',
+                                         'collection': collection.name, 'image_id': str(img_id)})
+
+    sizes = master_sizes(lib)
+    report.sizes_checked = sizes is not None
+    thumb_sizes = thumbnail_sizes(lib)
+    if thumb_sizes is not None:
+        sizes = sizes or {}
+        sizes.update(thumb_sizes)
+    report.files_total = sum(2 if img.get('ThumbPath') else 1 for img in images.values())
+
+    def check(job):
+        kind, img_id, image, path, expected = job
+        problem = check_file(path, expected)
+        if problem is None:
+            report._add(checked=1)
+        else:
+            report._add(checked=1, problem={'kind': kind, 'problem': problem, 'image_id': img_id,
+                                            'guid': image.guid, 'path': os.path.relpath(path, lib.abspath)})
+
+    last_progress = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = set()
+        for job in _file_jobs(lib, sizes):
+            if len(in_flight) >= workers * 4:  # Don't queue up a future for every file in the library
+                _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            in_flight.add(pool.submit(check, job))
+            if progress is not None and time.time() - last_progress > progress_interval:
+                progress(report)
+                last_progress = time.time()
+        wait(in_flight)
+    report.finished = time.time()
+    if progress is not None:
+        progress(report)
+    return report
+
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith('-j')]
+    jobs = [int(a[2:]) for a in sys.argv[1:] if a.startswith('-j')]
+    if len(args) < 1:
+        print('usage: %s iphotolibrary [-jN]' % sys.argv[0])
+        print("""
+            Checks that every photo's master and thumbnail exist and can be read,
+            that they are the size iPhoto recorded, and that every album and
+            roll refers only to photos that exist.  Progress goes to stderr and a
+            JSON summary to stdout; the exit status is 1 if anything is wrong.
+            -jN checks N files at once (default 16).
+        """)
+        exit(1)
+
+    def progress(report):
+        print(str(report), file=sys.stderr)
+
+    report = verify_library(iPhotoLibrary(args[0]), workers=jobs[-1] if jobs else 16, progress=progress)
+    print(json.dumps(report.as_dict(), indent=2))
+    exit(0 if report.ok else 1)
+
+
+if __name__ == '__main__':
+    main()
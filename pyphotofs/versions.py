@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# Python 3, or Python 2 with the futures backport
+"""
+Finds the edited (rendered) version of images in an iPhoto library.
+
+Every version of a photo is described by a small binary plist at
+Database/Versions/<import group>/<master uuid>/Version-N.apversion, and the
+version that AlbumData.xml lists carries the same uuid as the image's GUID.
+When that version has adjustments, iPhoto renders it to a full-size JPEG
+under Previews/, in a folder named for the version just like Thumbnails/.
+
+There can be many thousands of these plists, so they are only read one
+import group at a time, when an image from that group is first asked for,
+and a pool of workers parses a group's plists together.  A group is read
+again for each new generation of the library, since iPhoto may have edited
+or added versions meanwhile.  What was learned is saved in the library's cache_dir keyed by each plist's size and
+modification time, so the next mount only re-reads plists that changed.
+"""
+from __future__ import print_function
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from iphoto import read_plist
+
+__author__ = "Robert Harder"
+__email__ = "rob@iharder.net"
+__copyright__ = "This code is released into the Public Domain"
+__version__ = "0.1"
+__status__ = "Development"
+
+
+def _read_version(path):
+    """
+    Reads just what we need from one Version-N.apversion.
+    :return: the version uuid and, if it has been edited, the preview folder relative to Previews/
+    :rtype: (str, str)
+    """
+    with open(path, 'rb') as fp:
+        version = read_plist(fp)
+    preview_dir = None
+    if version.get('hasAdjustments'):
+        proxy = version.get('imageProxyState', {})
+        thumb = proxy.get('thumbnailPath') or proxy.get('miniThumbnailPath')
+        if thumb:
+            preview_dir = os.path.dirname(thumb)
+    return version.get('uuid'), preview_dir
+
+
+class VersionIndex(object):
+    """
+    Maps images to the file holding their latest rendered version.
+    Safe to use from many threads at once.
+    """
+
+    _CACHE_FILE = 'versions.json'
+
+    def __init__(self, library, workers=8, verbose=False):
+        """
+        :param iphoto.iPhotoLibrary library: the library
+        :param int workers: how many version plists to read at once
+        """
+        self._library = library
+        self._workers = workers
+        self.verbose = verbose
+        self._versions_dir = os.path.join(library.abspath, 'Database', 'Versions')
+        self._previews_dir = os.path.join(library.abspath, 'Previews')
+        self._cache_path = os.path.join(library.cache_dir, self._CACHE_FILE)
+        self._preview_dir_by_uuid = {}  # version uuid -> preview folder relative to Previews/, or None
+        self._indexed_groups = {}  # group -> number of the generation it was last read for
+        self._group_locks = {}
+        self._lock = Lock()
+        self._persisted = self._load_persisted()  # plist relpath -> [mtime, size, uuid, preview dir]
+        self._dirty = False
+
+    def _load_persisted(self):
+        try:
+            with open(self._cache_path) as fp:
+                return json.load(fp).get('versions', {})
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save(self):
+        """
+        Writes what has been learned so far to the library's cache_dir.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps({'versions': self._persisted})
+            self._dirty = False
+        tmp = self._cache_path + '.tmp'
+        with open(tmp, 'w') as fp:
+            fp.write(data)
+        os.rename(tmp, self._cache_path)
+
+    def _group_lock(self, group):
+        with self._lock:
+            return self._group_locks.setdefault(group, Lock())
+
+    def _index_group(self, group, generation):
+        """
+        Reads (or recalls) every version plist in one import group, unless
+        that has already been done for this generation of the library.
+        :param str group: eg, 2016/02/05/20160205-213957
+        :param int generation: the number of the generation asking
+        """
+        with self._group_lock(group):
+            if self._indexed_groups.get(group) == generation:
+                return
+            group_dir = os.path.join(self._versions_dir, group)
+            to_read = []
+            found = {}
+            seen = set()
+            for master_dir in (os.listdir(group_dir) if os.path.isdir(group_dir) else []):
+                for name in os.listdir(os.path.join(group_dir, master_dir)):
+                    if not (name.startswith('Version-') and name.endswith('.apversion')):
+                        continue
+                    rel = os.path.join(group, master_dir, name)
+                    seen.add(rel)
+                    st = os.stat(os.path.join(self._versions_dir, rel))
+                    known = self._persisted.get(rel)
+                    if known is not None and known[0] == st.st_mtime and known[1] == st.st_size:
+                        found[known[2]] = known[3]
+                    else:
+                        to_read.append((rel, st))
+
+            if to_read:
+                if self.verbose:
+                    print("reading {} version plists in {}".format(len(to_read), group))
+                with ThreadPoolExecutor(max_workers=self._workers) as pool:
+                    paths = [os.path.join(self._versions_dir, rel) for rel, _ in to_read]
+                    for (rel, st), (uuid, preview_dir) in zip(to_read, pool.map(_read_version, paths)):
+                        found[uuid] = preview_dir
+                        with self._lock:
+                            self._persisted[rel] = [st.st_mtime, st.st_size, uuid, preview_dir]
+                            self._dirty = True
+
+            with self._lock:
+                self._preview_dir_by_uuid.update(found)
+                self._indexed_groups[group] = generation
+                prefix = group + os.sep
+                for rel in [rel for rel in self._persisted if rel.startswith(prefix) and rel not in seen]:
+                    del self._persisted[rel]  # Version deleted since it was saved
+                    self._dirty = True
+        self.save()
+
+    def edited_path(self, image):
+        """
+        Returns the file holding the image as it currently looks in iPhoto:
+        the rendered preview if it has been edited, otherwise the master.
+        :param iphoto.iPhotoImage image: the image
+        :return: an absolute path
+        :rtype: str
+        """
+        master = image.relpath
+        if master is None or not master.startswith('Masters' + os.sep):
+            return image.abspath  # Referenced (not managed) master; no versions to find
+        group = os.path.dirname(os.path.relpath(master, 'Masters'))
+        self._index_group(group, image._parentLibrary.number)
+
+        preview_dir = self._preview_dir_by_uuid.get(image.guid)
+        if preview_dir:
+            folder = os.path.join(self._previews_dir, preview_dir)
+            base, _ = os.path.splitext(image.filename)
+            for candidate in (base + '.jpg', base + '.JPG', image.filename):
+                if os.path.isfile(os.path.join(folder, candidate)):
+                    return os.path.join(folder, candidate)
+        return image.abspath